@@ -0,0 +1,211 @@
+import os
+import re
+import shutil
+
+CHECKPOINT_DIR_PATTERN = re.compile(r"^checkpoint_(\d+)$")
+CHECKPOINT_FILE_PATTERN = re.compile(r"^checkpoint-(\d+)(\.tune_metadata|\.extra_data)?$")
+METADATA_EXTENSIONS = (".tune_metadata", ".extra_data")
+# Ray releases before 0.6.5 also need the .extra_data file to restore a checkpoint.
+LEGACY_REQUIRED_METADATA = (".tune_metadata", ".extra_data")
+
+
+class CheckpointEntry(object):
+    """A single Ray Tune checkpoint: its iteration, data file and metadata files.
+    """
+
+    def __init__(self, trial_dir, iteration, required_metadata=(".tune_metadata",)):
+        self.trial_dir = trial_dir
+        self.iteration = iteration
+        self.required_metadata = required_metadata
+        # The checkpoint_<N> sub-directory holding the files, None for the old flat layout.
+        self.checkpoint_dir = None
+        self.path = None
+        self.metadata_files = {}
+
+    @property
+    def key(self):
+        return (self.iteration, self.trial_dir)
+
+    @property
+    def is_complete(self):
+        """Tune writes the .tune_metadata file after the checkpoint data, so its presence
+        marks a checkpoint that can be restored.
+        """
+        return self.path is not None and all(ext in self.metadata_files for ext in self.required_metadata)
+
+    @property
+    def files(self):
+        return [self.path] + [self.metadata_files[ext] for ext in sorted(self.metadata_files)]
+
+    @property
+    def directory(self):
+        return self.checkpoint_dir or self.trial_dir
+
+    @property
+    def missing_files(self):
+        """Names of the files the checkpoint still needs to be complete.
+        """
+        name = "checkpoint-%s" % self.iteration
+        missing = [] if self.path is not None else [name]
+        return missing + [name + ext for ext in self.required_metadata if ext not in self.metadata_files]
+
+
+class CheckpointIndex(object):
+    """Index of the Ray Tune checkpoints written under ``root_dir``.
+
+    Checkpoints are expected in the Tune layout ``<root_dir>/<experiment>/<trial>/``, either as
+    ``checkpoint_<N>/checkpoint-<N>[.tune_metadata]`` sub-directories or, for older Ray releases,
+    as ``checkpoint-<N>[.tune_metadata|.extra_data]`` files directly in the trial directory.
+
+    Checkpoints can be recorded as they are written with ``record_checkpoint``, or picked up by
+    ``refresh``, which only re-lists trial directories that changed since the last call. The
+    latest complete checkpoint is tracked as entries are added, so ``latest_complete`` is O(1).
+    """
+
+    def __init__(self, root_dir, required_metadata=(".tune_metadata",)):
+        """
+        Args:
+            root_dir (str): directory Tune writes the experiments to.
+            required_metadata (tuple): metadata file extensions a checkpoint needs to be
+                complete, e.g. LEGACY_REQUIRED_METADATA for Ray releases before 0.6.5.
+        """
+        self.root_dir = root_dir
+        self.required_metadata = tuple(required_metadata)
+        self._entries = {}
+        self._latest_complete = None
+        self._trial_dir_mtimes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, path):
+        """Adds a checkpoint data or metadata file to the index.
+
+        Returns:
+            CheckpointEntry: the entry the file belongs to, or None if it is not a checkpoint file.
+        """
+        match = CHECKPOINT_FILE_PATTERN.match(os.path.basename(path))
+        if not match:
+            return None
+        iteration, ext = int(match.group(1)), match.group(2)
+        parent_dir = os.path.dirname(path)
+        checkpoint_dir = None
+        if CHECKPOINT_DIR_PATTERN.match(os.path.basename(parent_dir)):
+            checkpoint_dir = parent_dir
+            trial_dir = os.path.dirname(parent_dir)
+        else:
+            trial_dir = parent_dir
+
+        entry = self._entries.get((iteration, trial_dir))
+        if entry is None:
+            entry = CheckpointEntry(trial_dir, iteration, self.required_metadata)
+            self._entries[entry.key] = entry
+        if checkpoint_dir is not None:
+            entry.checkpoint_dir = checkpoint_dir
+        if ext:
+            entry.metadata_files[ext] = path
+        else:
+            entry.path = path
+
+        if entry.is_complete and (self._latest_complete is None or entry.key > self._latest_complete.key):
+            self._latest_complete = entry
+        return entry
+
+    def record_checkpoint(self, path):
+        """Adds a checkpoint Tune just wrote, given the path it reports: the checkpoint data
+        file, whose metadata files sit next to it, or the checkpoint directory.
+
+        Returns:
+            CheckpointEntry: the entry of the checkpoint, or None if path is not a checkpoint.
+        """
+        if os.path.isdir(path):
+            self._scan(path)
+            match = CHECKPOINT_DIR_PATTERN.match(os.path.basename(os.path.normpath(path)))
+            if not match:
+                return None
+            return self._entries.get((int(match.group(1)), os.path.dirname(os.path.normpath(path))))
+        entry = self.record(path)
+        if entry is not None:
+            for ext in METADATA_EXTENSIONS:
+                if os.path.exists(path + ext):
+                    self.record(path + ext)
+        return entry
+
+    def refresh(self):
+        """Indexes checkpoints written since the last refresh.
+        """
+        for trial_dir in self._trial_dirs():
+            try:
+                mtime = os.stat(trial_dir).st_mtime_ns
+            except OSError:
+                continue
+            if self._trial_dir_mtimes.get(trial_dir) == mtime:
+                continue
+            self._trial_dir_mtimes[trial_dir] = mtime
+            self._scan(trial_dir)
+        # Checkpoint sub-directories may still have been filling up during the last scan.
+        for entry in list(self._entries.values()):
+            if not entry.is_complete and entry.checkpoint_dir is not None:
+                self._scan(entry.checkpoint_dir)
+
+    def latest(self):
+        """Returns the CheckpointEntry with the highest iteration, complete or not, or None.
+        """
+        if not self._entries:
+            return None
+        return self._entries[max(self._entries)]
+
+    def latest_complete(self):
+        """Returns the CheckpointEntry with the highest iteration that has all its files, or None.
+        """
+        return self._latest_complete
+
+    def copy_latest(self, output_dir, prefix="checkpoint"):
+        """Copies the latest complete checkpoint into ``output_dir`` as ``<prefix>[.ext]``.
+        Every file is first copied to a temporary name and then renamed into place, so readers
+        never see a partially written checkpoint.
+
+        Returns:
+            list: (source, destination) path pairs that were copied.
+        """
+        entry = self.latest_complete()
+        if entry is None:
+            raise RuntimeError("No complete checkpoint found in %s" % self.root_dir)
+
+        copies = []
+        for source_path in entry.files:
+            _, ext = os.path.splitext(source_path)
+            destination_path = os.path.join(output_dir, "%s%s" % (prefix, ext))
+            temp_path = "%s.tmp-%s" % (destination_path, os.getpid())
+            shutil.copyfile(source_path, temp_path)
+            copies.append((source_path, temp_path, destination_path))
+        for _, temp_path, destination_path in copies:
+            os.replace(temp_path, destination_path)
+        return [(source_path, destination_path) for source_path, _, destination_path in copies]
+
+    def _trial_dirs(self):
+        for experiment_dir in _list_dirs(self.root_dir):
+            for trial_dir in _list_dirs(experiment_dir):
+                yield trial_dir
+
+    def _scan(self, directory):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for dir_entry in entries:
+            if dir_entry.is_dir():
+                match = CHECKPOINT_DIR_PATTERN.match(dir_entry.name)
+                if match:
+                    known = self._entries.get((int(match.group(1)), directory))
+                    if known is None or not known.is_complete:
+                        self._scan(dir_entry.path)
+            elif CHECKPOINT_FILE_PATTERN.match(dir_entry.name):
+                self.record(dir_entry.path)
+
+
+def _list_dirs(path):
+    try:
+        return [entry.path for entry in os.scandir(path) if entry.is_dir()]
+    except OSError:
+        return []
@@ -1,27 +1,64 @@
-from rl_coach.agents.clipped_ppo_agent import ClippedPPOAgentParameters
-from rl_coach.agents.policy_gradients_agent import PolicyGradientsAgentParameters
-from rl_coach.graph_managers.basic_rl_graph_manager import BasicRLGraphManager
-from rl_coach.graph_managers.graph_manager import ScheduleParameters
-from rl_coach.base_parameters import VisualizationParameters, TaskParameters, Frameworks
-from rl_coach.utils import short_dynamic_import
-from rl_coach.core_types import SelectedPhaseOnlyDumpFilter, MaxDumpFilter, RunPhase
-import rl_coach.core_types 
-from rl_coach import logger
-from rl_coach.logger import screen
 import argparse
 import copy
 import logging
 import os
 import sys
 import shutil
-import glob
 import re
+import time
 
-from .configuration_list import ConfigurationList
+# Startup time is reported relative to this, so it includes the rl_coach (and TF) imports below.
+IMPORT_START_TIME = time.time()
+
+# Agent, graph manager and TF modules are imported where they are used, so a launch with a
+# cached preset doesn't import more of rl_coach than CoachLauncher itself needs.
+from rl_coach.base_parameters import Frameworks
+from rl_coach.utils import short_dynamic_import
+import rl_coach.core_types 
+from rl_coach import logger
+from rl_coach.logger import screen
 from rl_coach.coach import CoachLauncher
 
+from .configuration_list import ConfigurationList
+
+IMPORT_SECONDS = time.time() - IMPORT_START_TIME
+
 screen.set_use_colors(False)  # Simple text logging so it looks good in CloudWatch
 
+# Graph managers of the presets loaded in this process, keyed by preset file path and mtime.
+_PRESET_CACHE = {}
+
+# Tensors of the Coach PPO network exported for serving.
+TF_INPUT_TENSOR_NAME = 'main_level/agent/main/online/network_0/observation/observation:0'
+TF_OUTPUT_OP_NAME = 'main_level/agent/main/online/network_1/ppo_head_0/policy'
+
+# Coach names checkpoints "<checkpoint number>_Step-<step>.ckpt...".
+CHECKPOINT_NUMBER_PATTERN = re.compile(r'^(\d+)_Step', re.IGNORECASE)
+
+
+def find_latest_checkpoint(ckpt_dir, suffix):
+    """Returns the path of the latest file in ckpt_dir ending with suffix, or None.
+    Files are compared by the checkpoint number in their name, in a single pass over the directory.
+    Files whose names don't carry a checkpoint number rank below numbered ones, by modification time.
+    """
+    latest_key, latest_path = None, None
+    try:
+        with os.scandir(ckpt_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(suffix) or not entry.is_file():
+                    continue
+                match = CHECKPOINT_NUMBER_PATTERN.match(entry.name)
+                if match:
+                    key = (1, int(match.group(1)), 0)
+                else:
+                    key = (0, 0, entry.stat().st_mtime)
+                if latest_key is None or key > latest_key:
+                    latest_key, latest_path = key, entry.path
+    except OSError:
+        return None
+    return latest_path
+
+
 class CoachConfigurationList(ConfigurationList):
     """Helper Object for converting CLI arguments (or SageMaker hyperparameters) 
     into Coach configuration.
@@ -150,6 +187,30 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
                             help="(int) Flag to save model artifact after training finish",
                             default=0,
                             type=int)
+        parser.add_argument('--optimize_onnx',
+                            help="(int) Flag to optimize the exported ONNX model (constant folding, fusions)",
+                            default=0,
+                            type=int)
+        parser.add_argument('--quantize_onnx',
+                            help="(int) Flag to quantize the weights of the exported ONNX model to int8",
+                            default=0,
+                            type=int)
+        parser.add_argument('--onnx_tolerance',
+                            help="(float) Maximum output difference allowed for the optimized ONNX model",
+                            default=1e-4,
+                            type=float)
+        parser.add_argument('--onnx_external_data',
+                            help="(int) Flag to store the ONNX model weights in a separate .data file next to model.onnx, done automatically for large models",
+                            default=0,
+                            type=int)
+        parser.add_argument('--freeze_tf_model',
+                            help="(int) Flag to export a frozen graph with only the observation to policy ops",
+                            default=0,
+                            type=int)
+        parser.add_argument('--export_tflite',
+                            help="(int) Flag to also export the frozen policy graph as a TFLite flatbuffer",
+                            default=0,
+                            type=int)
         return parser
 
     def path_of_main_launcher(self):
@@ -165,10 +226,28 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
             return os.getcwd()
 
     def preset_from_name(self, preset_name):
+        """Loads the graph_manager of a preset file next to the main launcher.
+        A preset is imported once per process. Later launches, e.g. in a hyperparameter sweep,
+        get a fresh copy of the cached graph_manager, so hyperparameters applied to one launch
+        don't leak into the next.
+        """
         preset_path = self.path_of_main_launcher()
         print("Loading preset %s from %s" % (preset_name, preset_path))
-        preset_path = os.path.join(self.path_of_main_launcher(),preset_name) + '.py:graph_manager'
-        graph_manager = short_dynamic_import(preset_path, ignore_module_case=True)
+        preset_file = os.path.join(preset_path, preset_name) + '.py'
+        try:
+            cache_key = (preset_file, os.stat(preset_file).st_mtime_ns)
+        except OSError:
+            # Let short_dynamic_import resolve the file name (e.g. ignoring case) and report errors.
+            cache_key = None
+        cached_graph_manager = _PRESET_CACHE.get(cache_key)
+        if cached_graph_manager is not None:
+            return copy.deepcopy(cached_graph_manager)
+        start_time = time.time()
+        graph_manager = short_dynamic_import(preset_file + ':graph_manager', ignore_module_case=True)
+        print("Imported preset %s in %.2f seconds" % (preset_name, time.time() - start_time))
+        if cache_key is not None:
+            # Keep a pristine copy, the returned instance is modified by the caller.
+            _PRESET_CACHE[cache_key] = copy.deepcopy(graph_manager)
         return graph_manager
 
     def get_graph_manager_from_args(self, args):
@@ -185,16 +264,21 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
             for ap in graph_manager.agents_params:
                 for network_parameters in ap.network_wrappers.values():
                     network_parameters.framework = args.framework
+        print("Graph manager ready %.2f seconds after the launcher started (%.2f seconds importing rl_coach)"
+              % (time.time() - IMPORT_START_TIME, IMPORT_SECONDS))
         return graph_manager
 
-    def _save_tf_model(self):
+    def _save_tf_model(self, freeze=False, tflite=False):
+        import tensorflow as tf
         ckpt_dir = '/opt/ml/output/data/checkpoint'
         model_dir = '/opt/ml/model'
 
         # Re-Initialize from the checkpoint so that you will have the latest models up.
-        tf.train.init_from_checkpoint(ckpt_dir,
+        latest_index = find_latest_checkpoint(ckpt_dir, '.ckpt.index')
+        ckpt_path = latest_index[:-len('.index')] if latest_index else ckpt_dir
+        tf.train.init_from_checkpoint(ckpt_path,
                                       {'main_level/agent/online/network_0/': 'main_level/agent/online/network_0'})
-        tf.train.init_from_checkpoint(ckpt_dir,
+        tf.train.init_from_checkpoint(ckpt_path,
                                       {'main_level/agent/online/network_1/': 'main_level/agent/online/network_1'})
 
         # Create a new session with a new tf graph.
@@ -202,11 +286,12 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
         sess.run(tf.global_variables_initializer())  # initialize the checkpoint.
 
         # This is the node that will accept the input.
-        input_nodes = tf.get_default_graph().get_tensor_by_name('main_level/agent/main/online/' + \
-                                                                'network_0/observation/observation:0')
+        input_nodes = tf.get_default_graph().get_tensor_by_name(TF_INPUT_TENSOR_NAME)
         # This is the node that will produce the output.
-        output_nodes = tf.get_default_graph().get_operation_by_name('main_level/agent/main/online/' + \
-                                                                    'network_1/ppo_head_0/policy')
+        output_nodes = tf.get_default_graph().get_operation_by_name(TF_OUTPUT_OP_NAME)
+        if freeze:
+            # Serve a graph with only the observation -> policy ops, with the weights as constants.
+            sess, input_nodes, output_nodes = self._freeze_tf_graph(sess)
         # Save the model as a servable model.
         tf.saved_model.simple_save(session=sess,
                                    export_dir='model',
@@ -215,26 +300,74 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
         # Move to the appropriate folder. Don't mind the directory, this just works.
         # rl-cart-pole is the name of the model. Remember it.
         shutil.move('model/', model_dir + '/model/tf-model/00000001/')
+        if tflite:
+            # TFLite needs a frozen graph. The SavedModel is already written, so freezing here
+            # only affects the TFLite model.
+            if not freeze:
+                sess, input_nodes, output_nodes = self._freeze_tf_graph(sess)
+            self._save_tflite_model(sess, input_nodes, output_nodes.outputs[0],
+                                    os.path.join(model_dir, 'model', 'model.tflite'))
+        sess.close()
         # EASE will pick it up and upload to the right path.
         print("Success")
 
-    def _save_onnx_model(self):
-        from .onnx_utils import fix_onnx_model
+    def _freeze_tf_graph(self, sess):
+        """Freezes the observation -> policy subgraph of the session's graph.
+        Variables become constants, training-only nodes are stripped and, when the graph transform
+        tool is available, constants are folded. Returns a new session on the frozen graph with its
+        input tensor and output operation.
+        """
+        import tensorflow as tf
+        input_op_name = TF_INPUT_TENSOR_NAME.split(':')[0]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, sess.graph.as_graph_def(), [TF_OUTPUT_OP_NAME])
+        graph_def = tf.graph_util.remove_training_nodes(graph_def,
+                                                        protected_nodes=[input_op_name, TF_OUTPUT_OP_NAME])
+        try:
+            from tensorflow.tools.graph_transforms import TransformGraph
+            graph_def = TransformGraph(graph_def, [input_op_name], [TF_OUTPUT_OP_NAME],
+                                       ['strip_unused_nodes',
+                                        'fold_constants(ignore_errors=true)',
+                                        'fold_batch_norms',
+                                        'sort_by_execution_order'])
+        except ImportError:
+            screen.warning("TensorFlow graph transforms not available, constants are not folded.")
+        print("Frozen TF policy graph has %s nodes" % len(graph_def.node))
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        sess.close()
+        frozen_sess = tf.Session(graph=graph, config=tf.ConfigProto(allow_soft_placement=True))
+        return (frozen_sess, graph.get_tensor_by_name(TF_INPUT_TENSOR_NAME),
+                graph.get_operation_by_name(TF_OUTPUT_OP_NAME))
+
+    def _save_tflite_model(self, sess, input_tensor, output_tensor, filepath):
+        """Converts the (frozen) session graph to a TFLite flatbuffer.
+        """
+        import tensorflow as tf
+        lite = tf.lite if hasattr(tf, 'lite') else tf.contrib.lite
+        converter = lite.TFLiteConverter.from_session(sess, [input_tensor], [output_tensor])
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(converter.convert())
+        print("Saved TFLite model to %s" % filepath)
+
+    def _save_onnx_model(self, optimize=False, quantize=False, tolerance=1e-4, external_data=False):
+        from .onnx_utils import fix_onnx_model, optimize_onnx_model
         ckpt_dir = '/opt/ml/output/data/checkpoint'
         model_dir = '/opt/ml/model'
         # find latest onnx file
         # currently done by name, expected to be changed in future release of coach.
-        glob_pattern = os.path.join(ckpt_dir, '*.onnx')
-        onnx_files = [file for file in glob.iglob(glob_pattern, recursive=True)]
-        if len(onnx_files) > 0:
-            extract_step = lambda string: int(re.search('/(\d*)_Step.*', string, re.IGNORECASE).group(1))
-            onnx_files.sort(key=extract_step)
-            latest_onnx_file = onnx_files[-1]
+        latest_onnx_file = find_latest_checkpoint(ckpt_dir, '.onnx')
+        if latest_onnx_file is not None:
             # move to model directory
             filepath_from = os.path.abspath(latest_onnx_file)
             filepath_to = os.path.join(model_dir, "model.onnx")
             shutil.move(filepath_from, filepath_to)
-            fix_onnx_model(filepath_to)
+            fix_onnx_model(filepath_to, external_data=external_data)
+            if optimize or quantize:
+                optimize_onnx_model(filepath_to, quantize=quantize, tolerance=tolerance)
         else:
             screen.warning("No ONNX files found in {}".format(ckpt_dir))
         
@@ -252,9 +385,13 @@ class SageMakerCoachPresetLauncher(CoachLauncher):
         if sage_args.save_model == 1:
             backend = os.getenv('COACH_BACKEND', 'tensorflow')
             if backend == 'tensorflow':
-                trainer._save_tf_model()
+                trainer._save_tf_model(freeze=sage_args.freeze_tf_model == 1,
+                                       tflite=sage_args.export_tflite == 1)
             if backend == 'mxnet':
-                trainer._save_onnx_model()
+                trainer._save_onnx_model(optimize=sage_args.optimize_onnx == 1,
+                                         quantize=sage_args.quantize_onnx == 1,
+                                         tolerance=sage_args.onnx_tolerance,
+                                         external_data=sage_args.onnx_external_data == 1)
 
 
 class SageMakerCoachLauncher(SageMakerCoachPresetLauncher):
@@ -273,6 +410,9 @@ class SageMakerCoachLauncher(SageMakerCoachPresetLauncher):
     def get_graph_manager_from_args(self, args):
         """Returns the GraphManager object for coach to use to train by calling improve()
         """
+        from rl_coach.base_parameters import VisualizationParameters
+        from rl_coach.graph_managers.basic_rl_graph_manager import BasicRLGraphManager
+        from rl_coach.graph_managers.graph_manager import ScheduleParameters
         # NOTE: TaskParameters are not configurable at this time.
 
         # Visualization
@@ -310,6 +450,7 @@ class SageMakerCoachLauncher(SageMakerCoachPresetLauncher):
             "   return rl_coach.agents.dqn_agent.DQNAgentParameters()");
 
     def config_visualization(self, vis_params):
+        from rl_coach.core_types import SelectedPhaseOnlyDumpFilter, MaxDumpFilter, RunPhase
         vis_params.dump_gifs = True
         vis_params.video_dump_methods = [SelectedPhaseOnlyDumpFilter(RunPhase.TEST), MaxDumpFilter()]
         vis_params.print_networks_summary = True
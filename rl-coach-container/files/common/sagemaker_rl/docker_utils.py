@@ -1,3 +1,4 @@
+import os
 import socket
 import time
 
@@ -21,4 +22,52 @@ def get_ip_from_host(timeout=100, host_name=None):
         for %s in past %s seconds" % (host_name, timeout)
         raise RuntimeError(error_string)
 
-    return ip_address
\ No newline at end of file
+    return ip_address
+
+
+def _read_cgroup_value(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_container_cpu_limit():
+    """Returns the number of CPUs the container's cgroup quota allows (may be fractional),
+    or the host CPU count if no quota is set.
+    """
+    # cgroup v2
+    cpu_max = _read_cgroup_value("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return float(os.cpu_count())
+    # cgroup v1
+    quota = _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_cgroup_value("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return float(os.cpu_count())
+
+
+def get_container_memory_limit():
+    """Returns the container's cgroup memory limit in bytes, capped at the host's physical memory.
+    """
+    physical_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        limit = _read_cgroup_value(path)
+        if limit and limit.isdigit():
+            return min(int(limit), physical_memory)
+    return physical_memory
+
+
+def get_shm_size(path="/dev/shm"):
+    """Returns the free space in bytes of the shared memory mount, or 0 if it is missing.
+    """
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
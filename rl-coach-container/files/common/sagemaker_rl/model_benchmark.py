@@ -0,0 +1,186 @@
+"""
+Measures the CPU inference latency of exported policy models (ONNX files or TF SavedModels) on
+synthetic observations, e.g.
+
+    python -m sagemaker_rl.model_benchmark --model /opt/ml/model/model.onnx \
+        --metadata custom_files/model_metadata.json --max_batch_size 8 --fps 15
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+# Observation shapes (without the batch dimension) of the sensors listed in model_metadata.json.
+SENSOR_SHAPES = {
+    "FRONT_FACING_CAMERA": (120, 160, 1),
+    "STEREO_CAMERAS": (120, 160, 2),
+    "LIDAR": (64,),
+    "SECTOR_LIDAR": (8,),
+    # 8 sectors with 8 discretized distance values each
+    "DISCRETIZED_SECTOR_LIDAR": (64,),
+}
+DEFAULT_SENSORS = ["FRONT_FACING_CAMERA"]
+
+
+class OnnxModelRunner(object):
+    """
+    Runs an ONNX model with onnxruntime on CPU.
+    """
+
+    def __init__(self, model_path, num_threads=0):
+        import onnxruntime as ort
+        from .onnx_utils import ORT_INPUT_TYPES
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self._session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.inputs = [(model_input.name,
+                        [dim if isinstance(dim, int) and dim > 0 else None for dim in model_input.shape[1:]],
+                        np.dtype(ORT_INPUT_TYPES.get(model_input.type, "float32")))
+                       for model_input in self._session.get_inputs()]
+
+    def run(self, feeds):
+        return self._session.run(None, feeds)
+
+
+class SavedModelRunner(object):
+    """
+    Runs the serving signature of a TF SavedModel.
+    """
+
+    def __init__(self, model_path, num_threads=0):
+        import tensorflow as tf
+        self._session = tf.Session(graph=tf.Graph(),
+                                   config=tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                                         device_count={'GPU': 0}))
+        meta_graph = tf.saved_model.loader.load(self._session, [tf.saved_model.tag_constants.SERVING],
+                                                model_path)
+        signature = meta_graph.signature_def[tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        self.inputs = [(info.name,
+                        [dim.size if dim.size > 0 else None for dim in info.tensor_shape.dim[1:]],
+                        tf.as_dtype(info.dtype).as_numpy_dtype)
+                       for _, info in sorted(signature.inputs.items())]
+        self._outputs = [info.name for _, info in sorted(signature.outputs.items())]
+
+    def run(self, feeds):
+        return self._session.run(self._outputs, feed_dict=feeds)
+
+
+def find_saved_model(path):
+    """
+    Returns the directory holding saved_model.pb, which may be a version sub-directory of path.
+    """
+    if os.path.isfile(os.path.join(path, "saved_model.pb")):
+        return path
+    for root, dirs, files in sorted(os.walk(path), reverse=True):
+        if "saved_model.pb" in files:
+            return root
+    raise RuntimeError("No saved_model.pb found under %s" % path)
+
+
+def load_runner(model_path, num_threads=0):
+    if os.path.isdir(model_path):
+        return SavedModelRunner(find_saved_model(model_path), num_threads)
+    return OnnxModelRunner(model_path, num_threads)
+
+
+def sensor_shapes(metadata_path):
+    """
+    Observation shapes of the sensors in model_metadata.json, defaulting to the front camera.
+    """
+    sensors = DEFAULT_SENSORS
+    if metadata_path:
+        with open(metadata_path) as f:
+            sensors = json.load(f).get("sensor", DEFAULT_SENSORS)
+    unknown = [sensor for sensor in sensors if sensor not in SENSOR_SHAPES]
+    if unknown:
+        raise ValueError("Unknown sensor(s) %s in %s. Supported sensors: %s"
+                         % (", ".join(unknown), metadata_path, ", ".join(sorted(SENSOR_SHAPES))))
+    return [SENSOR_SHAPES[sensor] for sensor in sensors]
+
+
+def observation_shapes(runner, metadata_path=None):
+    """
+    Resolves the shape of every model input. Fully static shapes come from the model itself,
+    the others from the sensors described in the metadata, matched by input order.
+    """
+    sensors = sensor_shapes(metadata_path)
+    shapes = []
+    for i, (name, shape, _) in enumerate(runner.inputs):
+        if all(dim is not None for dim in shape):
+            shapes.append(tuple(shape))
+        elif i < len(sensors) and len(sensors[i]) == len(shape):
+            shapes.append(tuple(known if known is not None else sensor
+                                for known, sensor in zip(shape, sensors[i])))
+        else:
+            raise RuntimeError("Can't determine the shape of model input %s %s from the metadata" % (name, shape))
+    return shapes
+
+
+def benchmark(runner, shapes, batch_size, iterations=200, warmup=20, seed=0):
+    """
+    Times ``iterations`` forward passes on a random batch of observations.
+
+    Returns:
+        dict: p50/p99 latency in milliseconds and throughput in observations per second.
+    """
+    random_state = np.random.RandomState(seed)
+    feeds = {name: random_state.uniform(size=(batch_size,) + shape).astype(dtype)
+             for (name, _, dtype), shape in zip(runner.inputs, shapes)}
+    for _ in range(warmup):
+        runner.run(feeds)
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        runner.run(feeds)
+        latencies[i] = time.perf_counter() - start
+    return {
+        "batch_size": batch_size,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "throughput": float(batch_size * iterations / latencies.sum()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU inference latency of an exported policy model.")
+    parser.add_argument('--model', required=True, type=str,
+                        help="(string) Path of the ONNX file or the TF SavedModel directory")
+    parser.add_argument('--metadata', default=None, type=str,
+                        help="(string) Path of model_metadata.json describing the sensors")
+    parser.add_argument('--max_batch_size', default=1, type=int,
+                        help="(int) Benchmark batch sizes 1..max_batch_size")
+    parser.add_argument('--iterations', default=200, type=int,
+                        help="(int) Timed forward passes per batch size")
+    parser.add_argument('--num_threads', default=0, type=int,
+                        help="(int) Intra-op threads, 0 lets the runtime decide")
+    parser.add_argument('--fps', default=15.0, type=float,
+                        help="(float) Frame rate budget to check the batch size 1 latency against")
+    args = parser.parse_args(argv)
+    if args.max_batch_size < 1:
+        parser.error("--max_batch_size must be at least 1")
+    if args.iterations < 1:
+        parser.error("--iterations must be at least 1")
+    if args.fps <= 0:
+        parser.error("--fps must be positive")
+
+    runner = load_runner(args.model, args.num_threads)
+    shapes = observation_shapes(runner, args.metadata)
+    print("Benchmarking %s with input shapes %s" % (args.model, shapes))
+    results = []
+    for batch_size in range(1, args.max_batch_size + 1):
+        result = benchmark(runner, shapes, batch_size, args.iterations)
+        print("batch_size: %(batch_size)d, p50: %(p50_ms).2f ms, p99: %(p99_ms).2f ms, "
+              "throughput: %(throughput).1f obs/s" % result)
+        results.append(result)
+
+    budget_ms = 1000.0 / args.fps
+    verdict = "fits" if results[0]["p99_ms"] <= budget_ms else "does NOT fit"
+    print("p99 latency at batch size 1 (%.2f ms) %s the %.1f fps budget (%.2f ms)."
+          % (results[0]["p99_ms"], verdict, args.fps, budget_ms))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,93 @@
 """
 ONNX Utils to support multiple output heads in agent networks, until future releases of MXNet support this.
 """
+import os
+import re
+import uuid
+
 import onnx
 from onnx import helper, checker, TensorProto
 
+# Models above this size are saved with external data, so the weights are not serialized
+# into one in-memory protobuf message on top of the loaded model. Protobuf refuses to
+# serialize messages above 2GB at all.
+EXTERNAL_DATA_MODEL_SIZE = 256 * 1024 * 1024
+# Tensors above this size are moved to the external data file.
+EXTERNAL_DATA_SIZE_THRESHOLD = 1024
+
+CONTINUOUS_PPO_HEAD_PATTERN = re.compile(r"_continuousppohead\d+")
+DISCRETE_PPO_HEAD_PATTERN = re.compile(r"_discreteppohead\d+")
+Q_HEAD_PATTERN = re.compile(r"_qhead\d+")
+
+VALUE_HEAD_PATTERN = re.compile(r"_vhead\d+_squeeze\d+$")
+CONTINUOUS_PPO_LOG_STD_PATTERN = re.compile(r"_continuousppohead\d+_log_std$")
+CONTINUOUS_PPO_MEAN_PATTERN = re.compile(r"_continuousppohead\d+_dense\d+_fwd$")
+CONTINUOUS_PPO_STD_PATTERN = re.compile(r"_continuousppohead\d+_broadcast_mul\d+$")
+DISCRETE_PPO_BIAS_PATTERN = re.compile(r"_discreteppohead\d+_dense\d+_bias$")
+DISCRETE_PPO_POLICY_PATTERN = re.compile(r"_discreteppohead\d+_softmax\d+$")
 
-def get_correct_outputs(model):
+
+class GraphIndex(object):
     """
-    Collects the relevent outputs of the model, after identifying the type of RL Agent.
-    Currently supports continuous PPO, discrete PPO and DQN agents.
+    Name lookups over an ONNX graph, built in a single pass.
     """
-    graph_name = model.graph.output[0].name
-    if "_continuousppohead" in graph_name:
+
+    def __init__(self, graph):
+        self.inputs = {value_info.name: value_info for value_info in graph.input}
+        self.initializers = {tensor.name: tensor for tensor in graph.initializer}
+        self.nodes = {}
+        for node in graph.node:
+            for output_name in node.output:
+                self.nodes[output_name] = node
+        self.outputs = [value_info.name for value_info in graph.output]
+
+    def tensor_names(self):
+        """
+        All names a tensor can be referred to by: graph inputs, initializers and node outputs.
+        """
+        names = list(self.inputs)
+        names.extend(name for name in self.initializers if name not in self.inputs)
+        names.extend(self.nodes)
+        return names
+
+    def find(self, pattern):
+        """
+        Returns the single tensor name matching the regex pattern.
+        """
+        matches = sorted(set(name for name in self.tensor_names() if pattern.search(name)))
+        if len(matches) != 1:
+            raise Exception("Expected one tensor matching '%s' in the ONNX graph, found %s."
+                            % (pattern.pattern, matches or "none"))
+        return matches[0]
+
+    def leading_dim(self, name):
+        """
+        Returns the first dimension of a graph input or initializer.
+        """
+        if name in self.inputs:
+            return self.inputs[name].type.tensor_type.shape.dim[0].dim_value
+        return self.initializers[name].dims[0]
+
+
+def get_correct_outputs(model, index=None):
+    """
+    Collects the relevent outputs of the model, after identifying the type of RL Agent from any
+    of its outputs. Currently supports continuous PPO, discrete PPO and DQN agents.
+    """
+    index = index or GraphIndex(model.graph)
+    if any(CONTINUOUS_PPO_HEAD_PATTERN.search(name) for name in index.outputs):
         print("ONNX correction applied to continuous PPO agent.")
-        return ppo_continuous_outputs(model)
-    elif "_discreteppohead" in graph_name:
+        return ppo_continuous_outputs(model, index)
+    elif any(DISCRETE_PPO_HEAD_PATTERN.search(name) for name in index.outputs):
         print("ONNX correction applied to discrete PPO agent.")
-        return ppo_discrete_outputs(model)
-    elif "_qhead" in graph_name:
+        return ppo_discrete_outputs(model, index)
+    elif any(Q_HEAD_PATTERN.search(name) for name in index.outputs):
         print("ONNX correction not required for DQN agent.")
         return model.graph.output
     else:
         raise Exception("Can't determine the RL Agent used from the ONNX graph provided.")
 
-        
+
 def make_output(node_name, shape):
     """
     Given a node name and output shape, will construct the correct Protobuf object.
@@ -35,64 +99,188 @@ def make_output(node_name, shape):
     )
 
 
-def ppo_continuous_outputs(model):
+def ppo_continuous_outputs(model, index=None):
     """
     Collects the output nodes for continuous PPO.
     """
-    # determine number of actions 
-    log_std_node_name = "generalmodel0_singlemodel1_scaledgradhead0_continuousppohead0_log_std"
-    log_std_node = [i for i in model.graph.input if i.name == log_std_node_name][0]
-    num_actions = log_std_node.type.tensor_type.shape.dim[0].dim_value
+    index = index or GraphIndex(model.graph)
+    # determine number of actions
+    num_actions = index.leading_dim(index.find(CONTINUOUS_PPO_LOG_STD_PATTERN))
     # identify output nodes
-    value_head_name = "generalmodel0_singlemodel0_scaledgradhead0_vhead0_squeeze0"
-    value_head = make_output(value_head_name, shape=(1,))
-    policy_head_mean_name = "generalmodel0_singlemodel1_scaledgradhead0_continuousppohead0_dense0_fwd"
-    policy_head_mean = make_output(policy_head_mean_name, shape=(num_actions,))
-    policy_head_std_name = "generalmodel0_singlemodel1_scaledgradhead0_continuousppohead0_broadcast_mul0"
-    policy_head_std = make_output(policy_head_std_name, shape=(num_actions,))
+    value_head = make_output(index.find(VALUE_HEAD_PATTERN), shape=(1,))
+    policy_head_mean = make_output(index.find(CONTINUOUS_PPO_MEAN_PATTERN), shape=(num_actions,))
+    policy_head_std = make_output(index.find(CONTINUOUS_PPO_STD_PATTERN), shape=(num_actions,))
     # collect outputs
     output_nodes = [value_head, policy_head_mean, policy_head_std]
     return output_nodes
 
 
-def ppo_discrete_outputs(model):
+def ppo_discrete_outputs(model, index=None):
     """
     Collects the output nodes for discrete PPO.
     """
-    # determine number of actions 
-    bias_node_name = "generalmodel0_singlemodel1_scaledgradhead0_discreteppohead0_dense0_bias"
-    bias_node = [i for i in model.graph.input if i.name == bias_node_name][0]
-    num_actions = bias_node.type.tensor_type.shape.dim[0].dim_value
+    index = index or GraphIndex(model.graph)
+    # determine number of actions
+    num_actions = index.leading_dim(index.find(DISCRETE_PPO_BIAS_PATTERN))
     # identify output nodes
-    value_head_name = "generalmodel0_singlemodel0_scaledgradhead0_vhead0_squeeze0"
-    value_head = make_output(value_head_name, shape=(1,))
-    policy_head_name = "generalmodel0_singlemodel1_scaledgradhead0_discreteppohead0_softmax0"
-    policy_head = make_output(policy_head_name, shape=(num_actions,))
+    value_head = make_output(index.find(VALUE_HEAD_PATTERN), shape=(1,))
+    policy_head = make_output(index.find(DISCRETE_PPO_POLICY_PATTERN), shape=(num_actions,))
     # collect outputs
     output_nodes = [value_head, policy_head]
     return output_nodes
 
 
-def save_model(model, output_nodes, filepath):
+def save_model(model, output_nodes, filepath, external_data=False):
     """
-    Given an in memory model, will save to disk at given filepath.
+    Given an in memory model, will rewrite its outputs in place and save to disk at given filepath.
+    The model is written to a temporary file and renamed over filepath, so readers never see a
+    partial model. With external_data, or for models above EXTERNAL_DATA_MODEL_SIZE, large
+    initializers are stored next to the model in a '<filename>.<id>.data' file. Every save writes
+    a new data file, which only the renamed model refers to, so the model and its data can't get
+    out of sync. Data files of earlier saves are removed afterwards.
     """
-    new_graph = helper.make_graph(nodes=model.graph.node,
-                                  name='new_graph',
-                                  inputs=model.graph.input,
-                                  outputs=output_nodes,
-                                  initializer=model.graph.initializer)
-    checker.check_graph(new_graph)
-    new_model = helper.make_model(new_graph)
-    with open(filepath, "wb") as file_handle:
-        serialized = new_model.SerializeToString()
-        file_handle.write(serialized)
- 
+    if output_nodes is not model.graph.output:
+        del model.graph.output[:]
+        model.graph.output.extend(output_nodes)
+
+    directory, filename = os.path.split(os.path.abspath(filepath))
+    temp_path = os.path.join(directory, ".%s.tmp-%s" % (filename, os.getpid()))
+    data_location = None
+    if external_data or model.ByteSize() > EXTERNAL_DATA_MODEL_SIZE:
+        data_location = "%s.%s.data" % (filename, uuid.uuid4().hex[:12])
+    try:
+        if data_location is not None:
+            onnx.save_model(model, temp_path,
+                            save_as_external_data=True,
+                            all_tensors_to_one_file=True,
+                            location=data_location,
+                            size_threshold=EXTERNAL_DATA_SIZE_THRESHOLD)
+        else:
+            onnx.save_model(model, temp_path)
+        # The checker loads external data relative to the model path, so check the file itself.
+        checker.check_model(temp_path)
+        os.replace(temp_path, filepath)
+    except Exception:
+        for path in (temp_path, data_location and os.path.join(directory, data_location)):
+            if path and os.path.exists(path):
+                os.remove(path)
+        raise
+    _remove_stale_data_files(directory, filename, keep=data_location)
+
+
+def _remove_stale_data_files(directory, filename, keep=None):
+    """
+    Removes the external data files of earlier saves of the model filename in directory.
+    """
+    for name in os.listdir(directory):
+        if name != keep and name.startswith(filename + ".") and name.endswith(".data"):
+            os.remove(os.path.join(directory, name))
+
 
-def fix_onnx_model(filepath):
+def fix_onnx_model(filepath, external_data=False):
     """
-    Applies an inplace fix to ONNX file from Coach. 
+    Applies an inplace fix to ONNX file from Coach.
     """
     model = onnx.load_model(filepath)
     output_nodes = get_correct_outputs(model)
-    save_model(model, output_nodes, filepath)
+    save_model(model, output_nodes, filepath, external_data=external_data)
+
+
+ORT_INPUT_TYPES = {
+    "tensor(float)": "float32",
+    "tensor(double)": "float64",
+    "tensor(float16)": "float16",
+    "tensor(int64)": "int64",
+    "tensor(int32)": "int32",
+}
+
+
+def _ort_session(filepath, optimization_level, optimized_model_filepath=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = optimization_level
+    if optimized_model_filepath:
+        options.optimized_model_filepath = optimized_model_filepath
+    return ort.InferenceSession(filepath, options, providers=["CPUExecutionProvider"])
+
+
+def _random_feeds(session, seed=0):
+    """
+    Builds random inputs for every graph input of an onnxruntime session, using batch size 1
+    for symbolic dimensions.
+    """
+    import numpy as np
+    random_state = np.random.RandomState(seed)
+    feeds = {}
+    for model_input in session.get_inputs():
+        shape = [dim if isinstance(dim, int) and dim > 0 else 1 for dim in model_input.shape]
+        dtype = ORT_INPUT_TYPES.get(model_input.type, "float32")
+        if dtype.startswith("float"):
+            feeds[model_input.name] = random_state.standard_normal(shape).astype(dtype)
+        else:
+            feeds[model_input.name] = np.zeros(shape, dtype=dtype)
+    return feeds
+
+
+def _outputs_match(filepath, feeds, expected_outputs, tolerance):
+    import numpy as np
+    import onnxruntime as ort
+    session = _ort_session(filepath, ort.GraphOptimizationLevel.ORT_DISABLE_ALL)
+    outputs = session.run(None, feeds)
+    return len(outputs) == len(expected_outputs) and \
+        all(np.allclose(output, expected, rtol=tolerance, atol=tolerance)
+            for output, expected in zip(outputs, expected_outputs))
+
+
+def optimize_onnx_model(filepath, quantize=False, tolerance=1e-4, quantize_tolerance=1e-2):
+    """
+    Optimizes the ONNX model at filepath in place with onnxruntime: constant folding, removal of
+    redundant nodes and op fusions. With quantize, the weights are additionally quantized to int8
+    with dynamic quantization. Only the basic optimization level is used, so the model keeps to
+    standard ONNX ops and stays portable to other runtimes.
+
+    Each stage is kept only if its outputs match the original model within its tolerance on random
+    observations. Returns True if the model file was replaced.
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("onnxruntime is not installed, skipping ONNX optimization.")
+        return False
+
+    directory, filename = os.path.split(os.path.abspath(filepath))
+    optimized_path = os.path.join(directory, ".%s.optimized-%s" % (filename, os.getpid()))
+    quantized_path = os.path.join(directory, ".%s.quantized-%s" % (filename, os.getpid()))
+    try:
+        reference = _ort_session(filepath, ort.GraphOptimizationLevel.ORT_DISABLE_ALL)
+        feeds = _random_feeds(reference)
+        expected_outputs = reference.run(None, feeds)
+
+        best_path = filepath
+        _ort_session(filepath, ort.GraphOptimizationLevel.ORT_ENABLE_BASIC, optimized_path)
+        if _outputs_match(optimized_path, feeds, expected_outputs, tolerance):
+            best_path = optimized_path
+        else:
+            print("Optimized ONNX model outputs differ by more than %s, keeping the original graph." % tolerance)
+
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(best_path, quantized_path, weight_type=QuantType.QInt8)
+            if _outputs_match(quantized_path, feeds, expected_outputs, quantize_tolerance):
+                best_path = quantized_path
+            else:
+                print("Quantized ONNX model outputs differ by more than %s, keeping float weights."
+                      % quantize_tolerance)
+
+        if best_path == filepath:
+            return False
+        os.replace(best_path, filepath)
+        print("ONNX model optimized%s: %s" % (" and quantized" if best_path == quantized_path else "", filepath))
+        return True
+    except Exception as e:
+        print("ONNX optimization failed, keeping the original model: %s" % e)
+        return False
+    finally:
+        for temp_path in (optimized_path, quantized_path):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
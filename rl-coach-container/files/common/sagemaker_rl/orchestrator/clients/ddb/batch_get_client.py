@@ -0,0 +1,89 @@
+import logging
+import time
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+logger=logging.getLogger(__name__)
+
+# BatchGetItem accepts at most 100 keys per request
+MAX_KEYS_PER_BATCH = 100
+MAX_UNPROCESSED_RETRIES = 5
+
+
+class BatchGetClient(object):
+    """
+    Reads records by primary key from one or more tables with as few
+    BatchGetItem round trips as possible.
+    """
+    def __init__(self, consistent_read=True):
+        self.consistent_read = consistent_read
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def batch_get_records(self, requests):
+        """Fetch the records of the given keys
+
+        Args:
+            requests (list): (table_session, key) tuples, where key is a dict with
+                the primary key attributes of the record
+
+        Returns:
+            list: The record for every request in order, None for records not found
+        """
+        if not requests:
+            return []
+
+        if not all(hasattr(table_session, "meta") for table_session, _ in requests):
+            # not boto3 Table resources, read one by one
+            return [self._get_item(table_session, key) for table_session, key in requests]
+
+        # one BatchGetItem call can read any table of the account and region
+        client = requests[0][0].meta.client
+        pending = []
+        for table_session, key in requests:
+            request = (table_session.name, key)
+            if request not in pending:
+                pending.append(request)
+
+        records = {}
+        for start in range(0, len(pending), MAX_KEYS_PER_BATCH):
+            chunk = pending[start:start + MAX_KEYS_PER_BATCH]
+            request_items = {}
+            for table_name, key in chunk:
+                table_request = request_items.setdefault(
+                    table_name, {"Keys": [], "ConsistentRead": self.consistent_read})
+                table_request["Keys"].append(
+                    {name: self._serializer.serialize(value) for name, value in key.items()})
+            self._batch_get(client, request_items, chunk, records)
+
+        return [records.get(self._record_id(table_session.name, key, key))
+                for table_session, key in requests]
+
+    def _batch_get(self, client, request_items, chunk, records):
+        key_names = {table_name: list(key.keys()) for table_name, key in chunk}
+        num_retries = 0
+        while request_items:
+            response = client.batch_get_item(RequestItems=request_items)
+            for table_name, items in response.get("Responses", {}).items():
+                for item in items:
+                    record = {name: self._deserializer.deserialize(value) for name, value in item.items()}
+                    records[self._record_id(table_name, key_names[table_name], record)] = record
+
+            request_items = response.get("UnprocessedKeys") or {}
+            if request_items:
+                num_retries += 1
+                if num_retries > MAX_UNPROCESSED_RETRIES:
+                    raise RuntimeError(f"BatchGetItem left keys unprocessed after {MAX_UNPROCESSED_RETRIES} retries")
+                logger.debug("BatchGetItem returned unprocessed keys, retrying...")
+                time.sleep(0.05 * (2**num_retries))
+
+    def _get_item(self, table_session, key):
+        response = table_session.get_item(
+            Key=key,
+            ConsistentRead=self.consistent_read
+        )
+        return response.get("Item", None)
+
+    @staticmethod
+    def _record_id(table_name, key_names, record):
+        return (table_name, tuple((name, record[name]) for name in sorted(key_names)))
@@ -1,21 +1,72 @@
 import logging
-from boto3.dynamodb.conditions import Key
 from orchestrator.exceptions.ddb_client_exceptions import RecordAlreadyExistsException
 
 logger=logging.getLogger(__name__)
 
+
+class ExperimentRecordUpdate(object):
+    """
+    Unit of work collecting attribute changes of one experiment record. The changes
+    are written with a single UpdateItem when flushed, or when leaving the ``with`` block
+    without an exception.
+
+        with exp_db_client.batch_update(experiment_id) as update:
+            update.set('joining_workflow_metadata.joining_state', joining_state)
+            update.set('joining_workflow_metadata.next_join_job_id', None)
+    """
+    def __init__(self, exp_db_client, experiment_id):
+        self.exp_db_client = exp_db_client
+        self.experiment_id = experiment_id
+        self.attributes = {}
+        self.condition_expression = None
+        self.condition_values = None
+
+    def set(self, attribute_path, value):
+        """Set a (nested, dot separated) attribute, overriding earlier changes of it
+        """
+        self.attributes[attribute_path] = value
+        return self
+
+    def set_condition(self, condition_expression, condition_values=None):
+        """Only apply the changes if the record matches the condition
+        """
+        self.condition_expression = condition_expression
+        self.condition_values = condition_values
+        return self
+
+    def flush(self):
+        if self.attributes:
+            self.exp_db_client.update_experiment_attributes(
+                self.experiment_id,
+                self.attributes,
+                self.condition_expression,
+                self.condition_values
+            )
+        self.attributes = {}
+        self.condition_expression = None
+        self.condition_values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
 class ExperimentDbClient(object):
     def __init__(self, table_session):
         self.table_session = table_session
 
     def get_experiment_record(self, experiment_id):
-        response = self.table_session.query(
-            ConsistentRead=True,
-            KeyConditionExpression=Key('experiment_id').eq(experiment_id)
+        response = self.table_session.get_item(
+            Key=self.experiment_record_key(experiment_id),
+            ConsistentRead=True
         )
-        for i in response['Items']:
-            return i
-        return None
+        return response.get('Item', None)
+
+    def experiment_record_key(self, experiment_id):
+        return {'experiment_id': experiment_id}
 
     def create_new_experiment_record(self, record):
         try:
@@ -41,6 +92,41 @@ class ExperimentDbClient(object):
             }
         )
 
+    def batch_update(self, experiment_id):
+        return ExperimentRecordUpdate(self, experiment_id)
+
+    def update_experiment_attributes(self, experiment_id, attributes,
+                                     condition_expression=None, condition_values=None):
+        '''
+        Sets several (nested, dot separated) attributes of the ExperimentDb record for
+        experiment_id with a single UpdateItem, optionally only if condition_expression holds.
+        '''
+        attribute_names = {}
+        attribute_values = dict(condition_values or {})
+        set_clauses = []
+        for i, (attribute_path, value) in enumerate(attributes.items()):
+            path_placeholders = []
+            for name in attribute_path.split('.'):
+                placeholder = f'#attr{len(attribute_names)}'
+                for existing_placeholder, existing_name in attribute_names.items():
+                    if existing_name == name:
+                        placeholder = existing_placeholder
+                        break
+                attribute_names[placeholder] = name
+                path_placeholders.append(placeholder)
+            set_clauses.append(f"{'.'.join(path_placeholders)} = :attr_val{i}")
+            attribute_values[f':attr_val{i}'] = value
+
+        update_args = dict(
+            Key={'experiment_id': experiment_id},
+            UpdateExpression='SET ' + ', '.join(set_clauses),
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues=attribute_values
+        )
+        if condition_expression is not None:
+            update_args['ConditionExpression'] = condition_expression
+        self.table_session.update_item(**update_args)
+
     ####  Update states for training workflow
     def update_training_workflow_metadata_with_validation(
             self,
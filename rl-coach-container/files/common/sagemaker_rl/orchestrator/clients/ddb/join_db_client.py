@@ -1,12 +1,24 @@
 import logging
 from boto3.dynamodb.conditions import Key
+from orchestrator.clients.ddb.pagination import paginate_query
+from orchestrator.clients.ddb.record_cache import RecordCache, DEFAULT_RECORD_TTL, \
+    invalidates_record_cache
 from orchestrator.exceptions.ddb_client_exceptions import RecordAlreadyExistsException
 
 logger=logging.getLogger(__name__)
 
+@invalidates_record_cache
 class JoinDbClient(object):
-    def __init__(self, table_session):
+    def __init__(self, table_session, cache_ttl=DEFAULT_RECORD_TTL):
         self.table_session = table_session
+        # reads are served from a cache, writes through this client invalidate it
+        self._cache = RecordCache(is_terminal=self.is_join_job_record_final, ttl=cache_ttl)
+
+    @staticmethod
+    def is_join_job_record_final(record):
+        """A join job record won't change on its own once the job ended.
+        """
+        return record.get("current_state") in ("SUCCEEDED", "FAILED", "CANCELLED")
 
     def check_join_job_record_exists(self, experiment_id, join_job_id):
         if self.get_join_job_record(experiment_id, join_job_id) is None:
@@ -15,13 +27,20 @@ class JoinDbClient(object):
             return True
 
     def get_join_job_record(self, experiment_id, join_job_id):
-        response = self.table_session.query(
-            ConsistentRead=True,
-            KeyConditionExpression=Key('experiment_id').eq(experiment_id) & Key('join_job_id').eq(join_job_id)
+        return self._cache.get(
+            (experiment_id, join_job_id),
+            lambda: self.get_join_job_record_from_table(experiment_id, join_job_id)
+        )
+
+    def get_join_job_record_from_table(self, experiment_id, join_job_id):
+        response = self.table_session.get_item(
+            Key=self.join_job_record_key(experiment_id, join_job_id),
+            ConsistentRead=True
         )
-        for i in response['Items']:
-            return i
-        return None
+        return response.get('Item', None)
+
+    def join_job_record_key(self, experiment_id, join_job_id):
+        return {'experiment_id': experiment_id, 'join_job_id': join_job_id}
 
     def create_new_join_job_record(self, record):
         try:
@@ -29,6 +48,7 @@ class JoinDbClient(object):
                 Item=record,
                 ConditionExpression='attribute_not_exists(join_job_id)'
             )
+            self._cache.invalidate((record['experiment_id'], record['join_job_id']))
         except Exception as e:
             if "ConditionalCheckFailedException" in str(e):
                 raise RecordAlreadyExistsException()
@@ -38,16 +58,26 @@ class JoinDbClient(object):
         self.table_session.put_item(
             Item=record
         )
+        self._cache.invalidate((record['experiment_id'], record['join_job_id']))
 
     def get_all_join_job_records_of_experiment(self, experiment_id):
-        response = self.table_session.query(
+        records = list(self.iter_all_join_job_records_of_experiment(experiment_id))
+        if records:
+            return records
+        else:
+            return None
+
+    def iter_all_join_job_records_of_experiment(self, experiment_id, attributes=None):
+        '''
+        Yields all join job records of experiment_id page by page, with only the
+        given attributes (e.g. ['join_job_id']) if attributes is not None.
+        '''
+        return paginate_query(
+            self.table_session,
+            attributes=attributes,
             ConsistentRead=True,
             KeyConditionExpression=Key('experiment_id').eq(experiment_id)
         )
-        if response['Items']:
-            return response['Items']
-        else:
-            return None
 
     def batch_delete_items(self, experiment_id, join_job_id_list):
         logger.warning("Deleting join job records of experiment...")
@@ -60,6 +90,7 @@ class JoinDbClient(object):
                         'join_job_id': join_job_id
                     }
                 )
+                self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_current_state(self, experiment_id, join_job_id, current_state):
         self.table_session.update_item(
@@ -67,6 +98,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET current_state = :val',
             ExpressionAttributeValues={':val': current_state}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_input_obs_data_s3_path(self, experiment_id, 
         join_job_id, input_obs_data_s3_path):
@@ -75,6 +107,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET input_obs_data_s3_path = :val',
             ExpressionAttributeValues={':val': input_obs_data_s3_path}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
         
     def update_join_job_input_reward_data_s3_path(self, experiment_id, 
         join_job_id, input_reward_data_s3_path):
@@ -83,6 +116,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET input_reward_data_s3_path = :val',
             ExpressionAttributeValues={':val': input_reward_data_s3_path}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_join_query_ids(self, experiment_id, join_job_id, join_query_ids):
         self.table_session.update_item(
@@ -90,6 +124,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET join_query_ids = :val',
             ExpressionAttributeValues={':val': join_query_ids}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_obs_end_time(self, experiment_id, join_job_id, obs_end_time):
         self.table_session.update_item(
@@ -97,6 +132,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET obs_end_time = :val',
             ExpressionAttributeValues={':val': obs_end_time}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_obs_start_time(self, experiment_id, join_job_id, obs_start_time):
         self.table_session.update_item(
@@ -104,6 +140,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET obs_start_time = :val',
             ExpressionAttributeValues={':val': obs_start_time}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_output_joined_eval_data_s3_path(self, experiment_id, 
         join_job_id, output_joined_eval_data_s3_path):
@@ -112,6 +149,7 @@ class JoinDbClient(object):
             UpdateExpression=f'SET output_joined_eval_data_s3_path = :val',
             ExpressionAttributeValues={':val': output_joined_eval_data_s3_path}
         )
+        self._cache.invalidate((experiment_id, join_job_id))
 
     def update_join_job_output_joined_train_data_s3_path(self, experiment_id, 
         join_job_id, output_joined_train_data_s3_path):
@@ -119,4 +157,5 @@ class JoinDbClient(object):
             Key={'experiment_id': experiment_id, 'join_job_id': join_job_id},
             UpdateExpression=f'SET output_joined_train_data_s3_path = :val',
             ExpressionAttributeValues={':val': output_joined_train_data_s3_path}
-        )
\ No newline at end of file
+        )
+        self._cache.invalidate((experiment_id, join_job_id))
\ No newline at end of file
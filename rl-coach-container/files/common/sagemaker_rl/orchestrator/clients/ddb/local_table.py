@@ -0,0 +1,324 @@
+import copy
+import json
+import logging
+import os
+import re
+from decimal import Decimal
+from threading import RLock
+
+from botocore.exceptions import ClientError
+
+logger=logging.getLogger(__name__)
+
+
+class LocalTable(object):
+    """
+    In-process stand-in for a boto3 DynamoDB Table resource, implementing the subset of
+    the Table interface used by the ddb clients: get_item, put_item, update_item,
+    delete_item, query and batch_writer, with condition and update expressions.
+
+    Items are kept in memory and, if ``path`` is given, persisted to that JSON file after
+    every write, so the tables survive restarts of the notebook or process. Numbers are
+    stored and returned as Decimal, as DynamoDB does.
+
+    Supported expressions, which cover everything the ddb clients issue:
+        ConditionExpression: attribute_exists(path), attribute_not_exists(path),
+            path = :val, path <> :val, joined with AND
+        UpdateExpression: SET path = :val, ... and REMOVE path, ...
+        KeyConditionExpression: boto3.dynamodb.conditions Key conditions
+    Other expressions are rejected with a ValidationException ClientError, like
+    DynamoDB does for invalid ones, so callers' ClientError handling applies.
+    """
+    def __init__(self, name, hash_key, range_key=None, path=None):
+        """
+        Args:
+            name (str): Name of the table
+            hash_key (str): Name of the partition key attribute
+            range_key (str): Name of the sort key attribute, if any
+            path (str): JSON file persisting the table, in-memory only if None
+        """
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.path = path
+        self._items = {}
+        self._lock = RLock()
+        self._defer_save = False
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for item in json.load(f, parse_float=Decimal, parse_int=Decimal):
+                    self._items[self._key_of(item)] = item
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, ExpressionAttributeNames=None):
+        with self._lock:
+            item = self._items.get(self._key_of(Key))
+            if item is None:
+                return {}
+            return {'Item': _project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None):
+        item = _to_ddb_types(Item)
+        key = self._key_of(item)
+        with self._lock:
+            self._check_condition('PutItem', self._items.get(key), ConditionExpression,
+                                  ExpressionAttributeNames, ExpressionAttributeValues)
+            self._items[key] = item
+            self._save()
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        key = self._key_of(Key)
+        values = _to_ddb_types(ExpressionAttributeValues or {})
+        with self._lock:
+            current = self._items.get(key)
+            self._check_condition('UpdateItem', current, ConditionExpression,
+                                  ExpressionAttributeNames, values)
+            # DynamoDB creates the item if it doesn't exist yet
+            item = copy.deepcopy(current) if current is not None else _to_ddb_types(dict(Key))
+            for action, path, value_name in _parse_update_expression(UpdateExpression, ExpressionAttributeNames,
+                                                                     values):
+                parent, attribute = _resolve_parent(item, path)
+                if parent is None:
+                    raise _client_error('ValidationException', 'UpdateItem',
+                                        'The document path provided in the update expression is invalid for update')
+                if action == 'SET':
+                    parent[attribute] = copy.deepcopy(values[value_name])
+                else:
+                    parent.pop(attribute, None)
+            self._items[key] = item
+            self._save()
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        key = self._key_of(Key)
+        with self._lock:
+            self._check_condition('DeleteItem', self._items.get(key), ConditionExpression,
+                                  ExpressionAttributeNames, ExpressionAttributeValues)
+            self._items.pop(key, None)
+            self._save()
+        return {}
+
+    def query(self, KeyConditionExpression, ConsistentRead=False, ProjectionExpression=None,
+              ExpressionAttributeNames=None, ExclusiveStartKey=None, Limit=None, ScanIndexForward=True):
+        with self._lock:
+            keys = sorted(key for key, item in self._items.items()
+                          if _matches_key_condition(KeyConditionExpression, item))
+            if not ScanIndexForward:
+                keys.reverse()
+            if ExclusiveStartKey is not None:
+                start_key = self._key_of(ExclusiveStartKey)
+                keys = keys[keys.index(start_key) + 1:] if start_key in keys else \
+                    [key for key in keys if (key > start_key) == ScanIndexForward]
+
+            response = {}
+            if Limit is not None and len(keys) > Limit:
+                keys = keys[:Limit]
+                response['LastEvaluatedKey'] = self._key_attributes(self._items[keys[-1]])
+            response['Items'] = [_project(self._items[key], ProjectionExpression, ExpressionAttributeNames)
+                                 for key in keys]
+            response['Count'] = len(keys)
+            return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _LocalBatchWriter(self)
+
+    def _key_attributes(self, item):
+        key = {self.hash_key: item[self.hash_key]}
+        if self.range_key is not None:
+            key[self.range_key] = item[self.range_key]
+        return key
+
+    def _key_of(self, item):
+        try:
+            if self.range_key is None:
+                return (item[self.hash_key],)
+            return (item[self.hash_key], item[self.range_key])
+        except KeyError:
+            raise _client_error('ValidationException', 'GetItem',
+                                'The provided key element does not match the schema')
+
+    def _check_condition(self, operation, item, condition_expression, names, values):
+        if condition_expression is None:
+            return
+        if not _evaluate_condition(operation, condition_expression, item or {}, names,
+                                   _to_ddb_types(values or {})):
+            raise _client_error('ConditionalCheckFailedException', operation, 'The conditional request failed')
+
+    def _save(self):
+        if self.path is None or self._defer_save:
+            return
+        temp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            json.dump(list(self._items.values()), f, default=_json_number)
+        os.replace(temp_path, self.path)
+
+
+class _LocalBatchWriter(object):
+    """Applies batched writes right away and persists the table once at the end
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+    def __enter__(self):
+        self.table._lock.acquire()
+        self.table._defer_save = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.table._defer_save = False
+        try:
+            self.table._save()
+        finally:
+            self.table._lock.release()
+
+
+def _client_error(code, operation, message):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def _to_ddb_types(value):
+    """Converts numbers to Decimal, the way DynamoDB returns them
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_ddb_types(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_ddb_types(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def _json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _parse_path(path, names):
+    return [(names or {}).get(part, part) for part in path.strip().split('.')]
+
+
+def _get_path(item, path):
+    value = item
+    for attribute in path:
+        if not isinstance(value, dict) or attribute not in value:
+            return None, False
+        value = value[attribute]
+    return value, True
+
+
+def _resolve_parent(item, path):
+    parent, found = _get_path(item, path[:-1])
+    if not found or not isinstance(parent, dict):
+        return None, None
+    return parent, path[-1]
+
+
+def _project(item, projection_expression, names):
+    if not projection_expression:
+        return copy.deepcopy(item)
+    projected = {}
+    for path in projection_expression.split(','):
+        path = _parse_path(path, names)
+        value, found = _get_path(item, path)
+        if found:
+            target = projected
+            for attribute in path[:-1]:
+                target = target.setdefault(attribute, {})
+            target[path[-1]] = copy.deepcopy(value)
+    return projected
+
+
+_CONDITION_FUNCTION = re.compile(r'^(attribute_exists|attribute_not_exists)\s*\(\s*([^)]+?)\s*\)$')
+_CONDITION_COMPARISON = re.compile(r'^(.+?)\s*(=|<>)\s*(:\w+)$')
+
+
+def _evaluate_condition(operation, expression, item, names, values):
+    for clause in re.split(r'\s+AND\s+', expression.strip(), flags=re.IGNORECASE):
+        clause = clause.strip()
+        function = _CONDITION_FUNCTION.match(clause)
+        comparison = _CONDITION_COMPARISON.match(clause)
+        if function:
+            _, found = _get_path(item, _parse_path(function.group(2), names))
+            if found != (function.group(1) == 'attribute_exists'):
+                return False
+        elif comparison:
+            value_name = comparison.group(3)
+            if value_name not in values:
+                raise _client_error('ValidationException', operation,
+                                    f"An expression attribute value used in expression is not defined; "
+                                    f"attribute value: {value_name}")
+            value, found = _get_path(item, _parse_path(comparison.group(1), names))
+            equal = found and value == values[value_name]
+            if equal != (comparison.group(2) == '='):
+                return False
+        else:
+            raise _client_error('ValidationException', operation,
+                                f"Invalid ConditionExpression: '{clause}' is not supported by LocalTable")
+    return True
+
+
+def _parse_update_expression(expression, names, values):
+    """Returns (action, path, value placeholder) tuples of an update expression
+    """
+    actions = []
+    for action, clauses in re.findall(r'(SET|REMOVE)\s+(.*?)(?=\s+(?:SET|REMOVE)\s+|$)',
+                                      expression.strip(), flags=re.IGNORECASE | re.DOTALL):
+        action = action.upper()
+        for clause in clauses.split(','):
+            if action == 'SET':
+                path, _, value_name = clause.partition('=')
+                value_name = value_name.strip()
+                if not re.match(r'^:\w+$', value_name):
+                    raise _client_error('ValidationException', 'UpdateItem',
+                                        f"Invalid UpdateExpression: '{clause.strip()}' is not supported by LocalTable")
+                if value_name not in values:
+                    raise _client_error('ValidationException', 'UpdateItem',
+                                        f"An expression attribute value used in expression is not defined; "
+                                        f"attribute value: {value_name}")
+                actions.append((action, _parse_path(path, names), value_name))
+            else:
+                actions.append((action, _parse_path(clause, names), None))
+    if not actions:
+        raise _client_error('ValidationException', 'UpdateItem',
+                            f"Invalid UpdateExpression: '{expression}' is not supported by LocalTable")
+    return actions
+
+
+def _matches_key_condition(condition, item):
+    expression = condition.get_expression()
+    operator, operands = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(_matches_key_condition(operand, item) for operand in operands)
+    name = operands[0].name
+    if name not in item:
+        return False
+    value = item[name]
+    expected = [_to_ddb_types(operand) for operand in operands[1:]]
+    if operator == '=':
+        return value == expected[0]
+    elif operator == '<':
+        return value < expected[0]
+    elif operator == '<=':
+        return value <= expected[0]
+    elif operator == '>':
+        return value > expected[0]
+    elif operator == '>=':
+        return value >= expected[0]
+    elif operator == 'BETWEEN':
+        return expected[0] <= value <= expected[1]
+    elif operator == 'begins_with':
+        return value.startswith(expected[0])
+    raise _client_error('ValidationException', 'Query',
+                        f"Invalid KeyConditionExpression: operator '{operator}' is not supported by LocalTable")
@@ -2,16 +2,32 @@ import logging
 import time
 
 from boto3.dynamodb.conditions import Key
+from orchestrator.clients.ddb.pagination import paginate_query
+from orchestrator.clients.ddb.record_cache import RecordCache, DEFAULT_RECORD_TTL, \
+    invalidates_record_cache
 from orchestrator.exceptions.ddb_client_exceptions import RecordAlreadyExistsException
 
 logger=logging.getLogger(__name__)
 
+@invalidates_record_cache
 class ModelDbClient:
     """
     TODO: Deprecate and embed this class in ModelRecord. 
     """
-    def __init__(self, table_session):
+    def __init__(self, table_session, cache_ttl=DEFAULT_RECORD_TTL):
         self.table_session = table_session
+        # reads are served from a cache, writes through this client invalidate it
+        self._cache = RecordCache(is_terminal=self.is_model_record_final, ttl=cache_ttl)
+
+    @staticmethod
+    def is_model_record_final(record):
+        """A model record won't change on its own once training ended and
+        no evaluation is in progress.
+        """
+        train_state = record.get("train_state")
+        eval_state = record.get("eval_state")
+        train_ended = train_state is not None and train_state.endswith("ed")
+        return train_ended and (eval_state is None or eval_state.endswith("ed"))
 
     def check_model_record_exists(self, experiment_id, model_id):
         if self.get_model_record(experiment_id, model_id) is None:
@@ -20,13 +36,20 @@ class ModelDbClient:
             return True
 
     def get_model_record(self, experiment_id, model_id):
-        response = self.table_session.query(
-            ConsistentRead=True,
-            KeyConditionExpression=Key('experiment_id').eq(experiment_id) & Key('model_id').eq(model_id)
+        return self._cache.get(
+            (experiment_id, model_id),
+            lambda: self.get_model_record_from_table(experiment_id, model_id)
+        )
+
+    def get_model_record_from_table(self, experiment_id, model_id):
+        response = self.table_session.get_item(
+            Key=self.model_record_key(experiment_id, model_id),
+            ConsistentRead=True
         )
-        for i in response['Items']:
-            return i
-        return None
+        return response.get('Item', None)
+
+    def model_record_key(self, experiment_id, model_id):
+        return {'experiment_id': experiment_id, 'model_id': model_id}
 
     def get_model_record_with_retry(self, experiment_id, model_id, retry_gap=5):
         model_record = self.get_model_record(experiment_id, model_id)
@@ -42,6 +65,7 @@ class ModelDbClient:
                 Item=record,
                 ConditionExpression='attribute_not_exists(model_id)'
             )
+            self._cache.invalidate((record['experiment_id'], record['model_id']))
         except Exception as e:
             if "ConditionalCheckFailedException" in str(e):
                 raise RecordAlreadyExistsException()
@@ -76,16 +100,26 @@ class ModelDbClient:
         self.table_session.put_item(
             Item=record
         )
+        self._cache.invalidate((record['experiment_id'], record['model_id']))
 
     def get_all_model_records_of_experiment(self, experiment_id):
-        response = self.table_session.query(
+        records = list(self.iter_all_model_records_of_experiment(experiment_id))
+        if records:
+            return records
+        else:
+            return None
+
+    def iter_all_model_records_of_experiment(self, experiment_id, attributes=None):
+        '''
+        Yields all model records of experiment_id page by page, with only the
+        given attributes (e.g. ['model_id']) if attributes is not None.
+        '''
+        return paginate_query(
+            self.table_session,
+            attributes=attributes,
             ConsistentRead=True,
             KeyConditionExpression=Key('experiment_id').eq(experiment_id)
         )
-        if response['Items']:
-            return response['Items']
-        else:
-            return None
 
     def batch_delete_items(self, experiment_id, model_id_list):
         logger.warning("Deleting model records of experiment...")
@@ -98,6 +132,7 @@ class ModelDbClient:
                         'model_id': model_id
                     }
                 )
+                self._cache.invalidate((experiment_id, model_id))
 
     def update_model_input_model_id(self, experiment_id, model_id, input_model_id):
         self.table_session.update_item(
@@ -105,6 +140,7 @@ class ModelDbClient:
             UpdateExpression=f'SET input_model_id = :val',
             ExpressionAttributeValues={':val': input_model_id}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_input_data_s3_prefix(self, experiment_id, model_id, input_data_s3_prefix):
         self.table_session.update_item(
@@ -112,12 +148,14 @@ class ModelDbClient:
             UpdateExpression=f'SET input_data_s3_prefix = :val',
             ExpressionAttributeValues={':val': input_data_s3_prefix}
         )
+        self._cache.invalidate((experiment_id, model_id))
     def update_model_s3_model_output_path(self, experiment_id, model_id, s3_model_output_path):
         self.table_session.update_item(
             Key={'experiment_id': experiment_id, 'model_id': model_id},
             UpdateExpression=f'SET s3_model_output_path = :val',
             ExpressionAttributeValues={':val': s3_model_output_path}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_train_state(self, experiment_id, model_id, train_state):
         self.table_session.update_item(
@@ -125,6 +163,7 @@ class ModelDbClient:
             UpdateExpression=f'SET train_state = :val',
             ExpressionAttributeValues={':val': train_state}
         )
+        self._cache.invalidate((experiment_id, model_id))
     
     def update_model_eval_state(self, experiment_id, model_id, eval_state):
         self.table_session.update_item(
@@ -132,6 +171,7 @@ class ModelDbClient:
             UpdateExpression=f'SET eval_state = :val',
             ExpressionAttributeValues={':val': eval_state}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_eval_scores(self, experiment_id, model_id, eval_scores):
         self.table_session.update_item(
@@ -139,6 +179,7 @@ class ModelDbClient:
             UpdateExpression=f'SET eval_scores = :val',
             ExpressionAttributeValues={':val': eval_scores}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_eval_scores_and_state(self, experiment_id, model_id, eval_scores, eval_state):
         self.table_session.update_item(
@@ -148,7 +189,8 @@ class ModelDbClient:
                 ':score_val': eval_scores,
                 ':state_val': eval_state
             }
-        )         
+        )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_training_start_time(self, experiment_id, model_id, training_start_time):
         self.table_session.update_item(
@@ -156,6 +198,7 @@ class ModelDbClient:
             UpdateExpression=f'SET training_start_time = :val',
             ExpressionAttributeValues={':val': training_start_time}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_training_end_time(self, experiment_id, model_id, training_end_time):
         self.table_session.update_item(
@@ -163,6 +206,7 @@ class ModelDbClient:
             UpdateExpression=f'SET training_end_time = :val',
             ExpressionAttributeValues={':val': training_end_time}
         )
+        self._cache.invalidate((experiment_id, model_id))
 
     def update_model_training_stats(self, experiment_id, model_id,
         s3_model_output_path, training_start_time, training_end_time, train_state):
@@ -176,4 +220,5 @@ class ModelDbClient:
                 ':end_time_val': training_end_time,
                 ':state_val': train_state
             }
-        ) 
\ No newline at end of file
+        )
+        self._cache.invalidate((experiment_id, model_id)) 
\ No newline at end of file
@@ -0,0 +1,26 @@
+def paginate_query(table_session, attributes=None, **query_args):
+    """Yield every item matching a query, following LastEvaluatedKey across pages
+
+    Args:
+        table_session: DynamoDB table to query
+        attributes (list): Names of the top level attributes to fetch,
+            all attributes if None
+        query_args: Arguments of the query, e.g. KeyConditionExpression
+
+    Yields:
+        dict: Items of the query result
+    """
+    if attributes:
+        attribute_names = {f'#proj{i}': name for i, name in enumerate(attributes)}
+        query_args['ProjectionExpression'] = ', '.join(attribute_names.keys())
+        query_args['ExpressionAttributeNames'] = dict(
+            query_args.get('ExpressionAttributeNames', {}), **attribute_names)
+
+    while True:
+        response = table_session.query(**query_args)
+        for item in response['Items']:
+            yield item
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key:
+            return
+        query_args['ExclusiveStartKey'] = last_evaluated_key
@@ -0,0 +1,102 @@
+import copy
+import inspect
+import time
+from threading import Lock
+
+# Seconds a record which may still change is served from the cache
+DEFAULT_RECORD_TTL = 5
+
+# Table operations which modify a record
+TABLE_WRITE_OPERATIONS = ("put_item", "update_item", "delete_item")
+
+
+class RecordCache(object):
+    """
+    Thread safe read-through cache for DynamoDB records. Records in a terminal
+    state are kept until invalidated, other records for ``ttl`` seconds. Missing
+    records are never cached, so callers waiting for a record to appear always
+    read the table.
+    """
+    def __init__(self, is_terminal, ttl=DEFAULT_RECORD_TTL):
+        """
+        Args:
+            is_terminal (callable): Returns True for records that won't change
+                anymore, unless written through the owning client
+            ttl (float): Seconds to cache records not in a terminal state,
+                0 disables caching of those
+        """
+        self.is_terminal = is_terminal
+        self.ttl = ttl
+        self._records = {}
+        self._lock = Lock()
+        # bumped on every invalidation, so a read racing with a write is not cached
+        self._generation = 0
+
+    def get(self, key, load_record):
+        """Return the cached record for key, or load and cache it
+
+        Args:
+            key (tuple): Primary key values of the record
+            load_record (callable): Reads the record from the table
+
+        Returns:
+            dict: A copy of the record, or None if it does not exist
+        """
+        with self._lock:
+            cached = self._records.get(key)
+            generation = self._generation
+        if cached is not None:
+            record, expires_at = cached
+            if expires_at is None or time.time() < expires_at:
+                return copy.deepcopy(record)
+
+        record = load_record()
+        if record is not None:
+            if self.is_terminal(record):
+                expires_at = None
+            elif self.ttl > 0:
+                expires_at = time.time() + self.ttl
+            else:
+                return record
+            with self._lock:
+                if generation == self._generation:
+                    self._records[key] = (copy.deepcopy(record), expires_at)
+        return record
+
+    def invalidate(self, key=None):
+        """Drop the record of key from the cache, or all records if key is None
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._records.clear()
+            else:
+                self._records.pop(key, None)
+
+
+def invalidates_record_cache(cls):
+    """Class decorator checking that every method of a ddb client which writes
+    to the table also invalidates the client's RecordCache
+
+    Methods delegating the write to another method of the client are fine, as
+    that method is checked itself.
+
+    Raises:
+        TypeError: If a method writes to the table without invalidating
+    """
+    for name, method in inspect.getmembers(cls, inspect.isfunction):
+        names = _code_names(method.__code__)
+        if names.intersection(TABLE_WRITE_OPERATIONS) and "invalidate" not in names:
+            raise TypeError(f"{cls.__name__}.{name} writes to the table without "
+                            f"invalidating the record cache")
+    return cls
+
+
+def _code_names(code):
+    """Return the attribute and global names used by code and its nested code objects
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import time
 
 import boto3
@@ -14,6 +15,7 @@ from boto3.dynamodb.conditions import Key
 
 from orchestrator.clients.ddb.experiment_db_client import ExperimentDbClient
 from orchestrator.clients.ddb.join_db_client import JoinDbClient
+from orchestrator.clients.ddb.local_table import LocalTable
 from orchestrator.clients.ddb.model_db_client import ModelDbClient
 
 logger = logging.getLogger(__name__)
@@ -70,7 +72,16 @@ class ResourceManager(object):
         """Create shared resource across experiments, including
         experiment ddb table, joining job ddb table, model ddb table
         and IAM role to grant relevant resource permission
+
+        If ``local_db_dir`` is set in the shared resource config, the
+        tables are file-backed LocalTables in that directory instead,
+        and no CloudFormation stack is used.
         """
+        local_db_dir = self._resource_config.get("shared_resource").get("local_db_dir")
+        if local_db_dir:
+            self._create_local_db_clients(local_db_dir)
+            return
+
         if self._usable_shared_cf_stack_exists():
             logger.info("Using Resources in CloudFormation stack named: {} " \
                 "for Shared Resources.".format(self.shared_resource_stack_name))
@@ -95,6 +106,31 @@ class ResourceManager(object):
         model_db_session = self.boto_session.resource('dynamodb').Table(self.model_db_table_name)
         self.model_db_client = ModelDbClient(model_db_session)
 
+    def _create_local_db_clients(self, local_db_dir):
+        """Initialize the DynamoDb clients with in-process tables persisted
+        under local_db_dir. The IAM role is taken from the iam_role config.
+
+        Args:
+            local_db_dir (str): Directory holding one JSON file per table
+        """
+        logger.info(f"Using local tables in {local_db_dir} for Shared Resources.")
+        os.makedirs(local_db_dir, exist_ok=True)
+        self.exp_db_table_name = self._get_experiment_db_property("table_name")
+        self.join_db_table_name = self._get_join_db_property("table_name")
+        self.model_db_table_name = self._get_model_db_property("table_name")
+        self.iam_role_arn = self._get_iam_role_property("role_arn") or sagemaker.get_execution_role()
+
+        def local_table(table_name, hash_key, range_key=None):
+            return LocalTable(table_name, hash_key, range_key,
+                              path=os.path.join(local_db_dir, f"{table_name}.json"))
+
+        self.exp_db_client = ExperimentDbClient(
+            local_table(self.exp_db_table_name, "experiment_id"))
+        self.join_db_client = JoinDbClient(
+            local_table(self.join_db_table_name, "experiment_id", "join_job_id"))
+        self.model_db_client = ModelDbClient(
+            local_table(self.model_db_table_name, "experiment_id", "model_id"))
+
     def _usable_shared_cf_stack_exists(self):
         """Check if the shared cf stack exist and is usable
         
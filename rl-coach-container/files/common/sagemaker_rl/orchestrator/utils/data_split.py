@@ -0,0 +1,57 @@
+import hashlib
+
+# Ways to split joined data into training and evaluation data
+SAMPLE_PROB_SPLIT = "sample_prob"       # by the sample_prob stored with each observation
+EVENT_ID_HASH_SPLIT = "event_id_hash"   # by a hash of the event_id, reproducible across joins
+SPLIT_METHODS = (SAMPLE_PROB_SPLIT, EVENT_ID_HASH_SPLIT)
+
+# Number of buckets event ids are hashed into
+HASH_SPLIT_BUCKETS = 10000
+
+
+def validate_split_method(split_method):
+    if split_method not in SPLIT_METHODS:
+        raise ValueError(f"Unknown split_method '{split_method}'. Expected one of {SPLIT_METHODS}.")
+
+
+def hash_split_threshold(ratio):
+    """Return the number of hash buckets assigned to the training data
+    """
+    return int(round(ratio * HASH_SPLIT_BUCKETS))
+
+
+def event_id_hash_bucket(event_id):
+    """Return the hash bucket of an event id, the same as computed by
+    ``event_id_hash_bucket_sql`` in Athena
+
+    Args:
+        event_id (str): Event id of the record
+
+    Returns:
+        int: Bucket in [0, HASH_SPLIT_BUCKETS)
+    """
+    digest = hashlib.md5(str(event_id).encode("utf_8")).digest()
+    return (int.from_bytes(digest[:8], "big") & 0x7FFFFFFFFFFFFFFF) % HASH_SPLIT_BUCKETS
+
+
+def event_id_hash_bucket_sql(column):
+    """Return the Athena SQL expression of the hash bucket of an event id column
+    """
+    return f"mod(bitwise_and(from_big_endian_64(substr(md5(to_utf8({column})), 1, 8)), " \
+        f"9223372036854775807), {HASH_SPLIT_BUCKETS})"
+
+
+def is_train_record(record, ratio, split_method=SAMPLE_PROB_SPLIT):
+    """Return whether a joined record belongs to the training data
+
+    Args:
+        record (dict): Joined record with event_id and sample_prob
+        ratio (float): Split ratio for training and evaluation data set
+        split_method (str): One of SPLIT_METHODS
+
+    Returns:
+        bool: True for training records, False for evaluation records
+    """
+    if split_method == EVENT_ID_HASH_SPLIT:
+        return event_id_hash_bucket(record["event_id"]) < hash_split_threshold(ratio)
+    return record["sample_prob"] <= ratio
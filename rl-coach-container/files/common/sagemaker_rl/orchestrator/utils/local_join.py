@@ -0,0 +1,205 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from orchestrator.utils.data_split import SAMPLE_PROB_SPLIT, EVENT_ID_HASH_SPLIT, \
+    event_id_hash_bucket, hash_split_threshold, validate_split_method
+from orchestrator.utils.s3_writer import S3StreamWriter
+
+logger = logging.getLogger(__name__)
+
+# Columns of the observation and rewards data, and of the joined data in the
+# order the Athena join query returns them
+OBS_COLUMNS = ["event_id", "action", "observation", "model_id", "action_prob", "sample_prob"]
+REWARDS_COLUMNS = ["event_id", "reward"]
+JOINED_COLUMNS = ["event_id", "action", "action_prob", "model_id", "observation", "sample_prob", "reward"]
+
+# Observation records joined per pandas merge
+DEFAULT_CHUNK_SIZE = 100000
+
+# Firehose delivers the observation data under YYYY/MM/DD/HH/ prefixes
+HOUR_PARTITION_PATTERN = re.compile(r"^(\d{4}/\d{2}/\d{2}/\d{2})/")
+
+
+def split_s3_path(path):
+    """Split an S3 path into bucket and prefix
+
+    Args:
+        path (str): S3 path like s3://bucket/prefix, or a local path
+
+    Returns:
+        tuple: (bucket, prefix), bucket is None for local paths
+    """
+    if not path.startswith("s3://"):
+        return None, path
+    bucket, _, prefix = path[len("s3://"):].partition("/")
+    return bucket, prefix.strip("/")
+
+
+class LocalJoinEngine(object):
+    """
+    Joins observation and reward data on event_id without Athena, reading
+    from S3, an S3 compatible store like MinIO, or a local directory.
+
+    The rewards are loaded into a pandas DataFrame and the observations are
+    streamed in chunks and hash joined against it, so memory is bounded by
+    the size of the rewards plus one chunk. The joined records are written
+    as csv files with the same layout as the Athena query results.
+    """
+    def __init__(self, s3_client=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            s3_client (botocore.client.S3): Client for S3 paths, e.g. created
+                with the endpoint_url of a MinIO deployment
+            chunk_size (int): Observation records joined at a time
+        """
+        self.s3_client = s3_client
+        self.chunk_size = chunk_size
+
+    def join(self, obs_path, rewards_path, train_output_path, eval_output_path,
+             ratio=0.8, start_time=None, end_time=None, split_method=SAMPLE_PROB_SPLIT):
+        """Join the observation and reward data and write the train/eval splits
+        in a single pass over the observations
+
+        Args:
+            obs_path (str): S3 or local path of the observation data
+            rewards_path (str): S3 or local path of the rewards data
+            train_output_path (str): S3 or local path for the training split
+            eval_output_path (str): S3 or local path for the evaluation split
+            ratio (float): Split ratio for training and evaluation data set
+            start_time (datetime): Starting hour of the observation data to join
+            end_time (datetime): Ending hour of the observation data to join
+            split_method (str): Split on the stored sample_prob or on a hash of
+                the event_id, see orchestrator.utils.data_split
+
+        Returns:
+            tuple: Paths of the training and evaluation data files
+        """
+        import pandas as pd
+
+        validate_split_method(split_method)
+        rewards = pd.DataFrame.from_records(
+            [record for chunk in self._iter_record_chunks(rewards_path, REWARDS_COLUMNS) for record in chunk],
+            columns=REWARDS_COLUMNS)
+        logger.info(f"Loaded {len(rewards)} rewards from {rewards_path}")
+
+        partition_filter = None
+        if start_time is not None and end_time is not None:
+            start_partition = start_time.strftime("%Y/%m/%d/%H")
+            end_partition = end_time.strftime("%Y/%m/%d/%H")
+            def partition_filter(relative_path):
+                match = HOUR_PARTITION_PATTERN.match(relative_path)
+                return match is not None and start_partition <= match.group(1) <= end_partition
+
+        timestamp = str(int(time.time()))
+        train_writer, train_file_path = self._open_output(train_output_path, f"local-joined-data-{timestamp}.csv")
+        eval_writer, eval_file_path = self._open_output(eval_output_path, f"local-joined-data-{timestamp}.csv")
+        num_obs, num_train, num_eval = 0, 0, 0
+        try:
+            header = (",".join(f'"{column}"' for column in JOINED_COLUMNS) + "\n").encode("utf_8")
+            train_writer.write(header)
+            eval_writer.write(header)
+            for records in self._iter_record_chunks(obs_path, OBS_COLUMNS, partition_filter):
+                obs = pd.DataFrame.from_records(records, columns=OBS_COLUMNS)
+                num_obs += len(obs)
+                joined = obs.merge(rewards, on="event_id", how="inner")
+                if joined.empty:
+                    continue
+                # athena returns json arrays of STRING columns as compact json text
+                joined["observation"] = joined["observation"].map(_json_string)
+                train_mask = self._train_mask(joined, ratio, split_method)
+                num_train += self._write_csv(train_writer, joined[train_mask])
+                num_eval += self._write_csv(eval_writer, joined[~train_mask])
+        except Exception:
+            for writer in (train_writer, eval_writer):
+                if isinstance(writer, S3StreamWriter):
+                    writer.abort()
+                else:
+                    writer.close()
+            raise
+        train_writer.close()
+        eval_writer.close()
+
+        logger.info(f"Joined {num_obs} observations into {num_train} training "
+                    f"and {num_eval} evaluation records")
+        return train_file_path, eval_file_path
+
+    def _train_mask(self, joined, ratio, split_method):
+        if split_method == EVENT_ID_HASH_SPLIT:
+            return joined["event_id"].map(event_id_hash_bucket) < hash_split_threshold(ratio)
+        return joined["sample_prob"] <= ratio
+
+    def _write_csv(self, writer, data):
+        if data.empty:
+            return 0
+        writer.write(data.to_csv(header=False, index=False, columns=JOINED_COLUMNS,
+                                 quoting=csv.QUOTE_ALL).encode("utf_8"))
+        return len(data)
+
+    def _open_output(self, output_path, file_name):
+        bucket, prefix = split_s3_path(output_path)
+        if bucket is None:
+            os.makedirs(prefix, exist_ok=True)
+            file_path = os.path.join(prefix, file_name)
+            return open(file_path, "wb"), file_path
+        key = f"{prefix}/{file_name}"
+        return S3StreamWriter(self.s3_client, bucket, key), f"s3://{bucket}/{key}"
+
+    def _iter_record_chunks(self, path, columns, path_filter=None):
+        """Yield lists of up to chunk_size records of the json lines files under path
+        """
+        chunk = []
+        for lines in self._iter_files(path, path_filter):
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                chunk.append(tuple(record.get(column) for column in columns))
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _iter_files(self, path, path_filter=None):
+        """Yield a line iterator for every data file under path
+        """
+        bucket, prefix = split_s3_path(path)
+        if bucket is None:
+            for root, _, files in sorted(os.walk(prefix)):
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    relative_path = os.path.relpath(file_path, prefix).replace(os.sep, "/")
+                    if self._is_data_file(relative_path, path_filter):
+                        with open(file_path, "rb") as f:
+                            yield gzip.GzipFile(fileobj=f) if file_name.endswith(".gz") else f
+            return
+
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/" if prefix else ""):
+            for s3_object in page.get("Contents", []):
+                key = s3_object["Key"]
+                relative_path = key[len(prefix):].lstrip("/")
+                if self._is_data_file(relative_path, path_filter):
+                    body = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+                    try:
+                        yield gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body.iter_lines()
+                    finally:
+                        body.close()
+
+    @staticmethod
+    def _is_data_file(relative_path, path_filter=None):
+        if not relative_path or relative_path.endswith("/") or relative_path.endswith(".metadata"):
+            return False
+        return path_filter is None or path_filter(relative_path)
+
+
+def _json_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"))
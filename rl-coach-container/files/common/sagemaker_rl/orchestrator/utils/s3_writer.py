@@ -0,0 +1,107 @@
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every part but the last one of a multipart upload to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class S3StreamWriter(io.RawIOBase):
+    """
+    Write-only file object streaming its content to an S3 object.
+
+    Written bytes are buffered up to ``part_size`` and uploaded as parts of
+    a multipart upload, so the memory used doesn't grow with the object
+    size. Objects smaller than one part are uploaded with a single
+    put_object on close. If an error occurs inside the ``with`` block, the
+    multipart upload is aborted and no object is created.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_PART_SIZE, **put_args):
+        """
+        Args:
+            s3_client (botocore.client.S3): Client used for the upload
+            bucket (str): Name of the S3 bucket
+            key (str): Key of the S3 object
+            part_size (int): Bytes per uploaded part, at least 5 MiB
+            put_args: Extra arguments of the upload, e.g. ContentType
+        """
+        super().__init__()
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size has to be at least {MIN_PART_SIZE} bytes")
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.put_args = put_args
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def close(self):
+        """Upload the buffered data and complete the object
+        """
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Body=bytes(self._buffer), Bucket=self.bucket,
+                                          Key=self.key, **self.put_args)
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts}
+                )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        """Discard the written data without creating the object
+        """
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                      UploadId=self._upload_id)
+            except Exception as e:
+                logger.warning(f"Failed to abort multipart upload of s3://{self.bucket}/{self.key}: {e}")
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                              **self.put_args)
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(Body=data, Bucket=self.bucket, Key=self.key,
+                                              UploadId=self._upload_id, PartNumber=part_number)
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        logger.debug(f"Uploaded part {part_number} of s3://{self.bucket}/{self.key}")
@@ -1,3 +1,4 @@
+import gzip
 import json
 import logging
 import time
@@ -30,6 +31,7 @@ except Exception as e:
 from botocore.exceptions import ClientError
 from sagemaker.local.local_session import LocalSession
 
+from orchestrator.clients.ddb.batch_get_client import BatchGetClient
 from orchestrator.clients.ddb.join_db_client import JoinDbClient
 from orchestrator.clients.ddb.model_db_client import ModelDbClient
 from orchestrator.clients.ddb.experiment_db_client import ExperimentDbClient
@@ -39,6 +41,8 @@ from orchestrator.workflow.datatypes.experiment_record import ExperimentRecord
 from orchestrator.resource_manager import Predictor
 from orchestrator.resource_manager import ResourceManager
 from orchestrator.utils.cloudwatch_logger import CloudWatchLogger
+from orchestrator.utils.data_split import SAMPLE_PROB_SPLIT
+from orchestrator.utils.s3_writer import S3StreamWriter
 from orchestrator.exceptions.ddb_client_exceptions import RecordAlreadyExistsException
 from orchestrator.exceptions.workflow_exceptions import UnhandledWorkflowException, \
     SageMakerHostingException, SageMakerTrainingJobException, WorkflowJoiningJobException, \
@@ -77,6 +81,19 @@ class JoiningState(str, Enum):
     FAILED = "FAILED"       # A joining job has been failed
     CANCELLED = "CANCELLED" # A joining job has been cancelled
 
+# Seconds between two syncs of the ExperimentManagerSyncThread. The thread polls at the
+# active interval while a workflow is in flight, then doubles the interval up to the
+# idle interval. Throttled reads back off exponentially up to the max backoff.
+SYNC_ACTIVE_INTERVAL = 2
+SYNC_IDLE_INTERVAL = 60
+SYNC_MAX_BACKOFF = 300
+
+DDB_THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
 # Using SageMakerTrainingJob primary status 
 TRAINING_JOB_STATUS_MAP = {
     "Pending": TrainingState.PENDING,
@@ -137,6 +154,7 @@ class ExperimentManagerSyncThread(Thread):
         self.model_db_client = experiment_manager.model_db_client
         self.join_db_client = experiment_manager.join_db_client
         self.sagemaker_client = experiment_manager.sagemaker_client
+        self.batch_get_client = BatchGetClient()
 
         # used to emit continuous CW Metrics (for Number type plot)
         self.latest_trained_model_id = None
@@ -146,8 +164,10 @@ class ExperimentManagerSyncThread(Thread):
 
         self.thread_running = Event()
         self.thread_running.set()
+        # set to cut the current wait short, e.g. right after a workflow was requested
+        self.wake_up = Event()
 
-    def _update_experiment_db_training_workflow_metadata(self, training_workflow_metadata):
+    def _update_experiment_db_training_workflow_metadata(self, training_workflow_metadata, training_job_record=None):
         """
         Three thing happens here:
         a) Checks if current TrainingWorkflowMetadata needs an update.
@@ -158,6 +178,8 @@ class ExperimentManagerSyncThread(Thread):
         Args:
             training_workflow_metadata (dict): A dictionary containing
                 training workflow related metadata
+            training_job_record (dict): ModelDb record of next_model_to_train,
+                if already fetched
         """
         if training_workflow_metadata is None:
             # A training request hasn't been made yet. 
@@ -183,8 +205,9 @@ class ExperimentManagerSyncThread(Thread):
             return
         else:
             # A training is in progress. Fetch the status of that training job from ModelDb.
-            training_job_record = self.model_db_client.get_model_record_with_retry(
-                self.experiment_id, next_model_to_train_id)
+            if training_job_record is None:
+                training_job_record = self.model_db_client.get_model_record_with_retry(
+                    self.experiment_id, next_model_to_train_id)
 
             # Get updated TrainingWorkflowState in {new_training_state}
             if training_job_record is None:
@@ -250,13 +273,16 @@ class ExperimentManagerSyncThread(Thread):
         self.experiment_manager.experiment_record._training_state = training_workflow_metadata['training_state']
             
 
-    def _update_experiment_db_evaluation_workflow_metadata(self, evaluation_workflow_metadata):
+    def _update_experiment_db_evaluation_workflow_metadata(self, evaluation_workflow_metadata,
+                                                           evaluation_job_record=None):
         """
         Update the evaluation workflow metadata in the experiment table
 
         Args:
             evaluation_workflow_metadata (dict): A dictionary containing
                 evaluation workflow related metadata
+            evaluation_job_record (dict): ModelDb record of the model under
+                evaluation, if already fetched
         """
         if evaluation_workflow_metadata is None:
             return
@@ -267,8 +293,9 @@ class ExperimentManagerSyncThread(Thread):
         # some evaluation request is in progress
         if evaluation_state is not None and evaluation_state.endswith("ING"):
             evaluation_model_id = next_evaluation_job_id.split('-eval-')[0]
-            evaluation_job_record = self.model_db_client.get_model_record(
-                self.experiment_id, evaluation_model_id)
+            if evaluation_job_record is None:
+                evaluation_job_record = self.model_db_client.get_model_record(
+                    self.experiment_id, evaluation_model_id)
 
             # if evaluation model record exists in the model table
             if evaluation_job_record is not None:
@@ -280,22 +307,18 @@ class ExperimentManagerSyncThread(Thread):
                     evaluation_state = EVALUATION_JOB_STATUS_MAP[eval_state_from_modeldb]
 
                 self.experiment_manager.experiment_record._evaluation_state = evaluation_state
-                # update table states via ddb client
-                self.exp_db_client.update_experiment_evaluation_state(
-                    self.experiment_id, evaluation_state
-                )
+                # update table states via ddb client, in a single write
+                with self.exp_db_client.batch_update(self.experiment_id) as update:
+                    update.set('evaluation_workflow_metadata.evaluation_state', evaluation_state)
 
-                if evaluation_state == EvaluationState.EVALUATED:
-                    self.experiment_manager.experiment_record._last_evaluation_job_id = next_evaluation_job_id
-                    self.experiment_manager.experiment_record._next_evaluation_job_id = None
+                    if evaluation_state == EvaluationState.EVALUATED:
+                        self.experiment_manager.experiment_record._last_evaluation_job_id = next_evaluation_job_id
+                        self.experiment_manager.experiment_record._next_evaluation_job_id = None
 
-                    self.exp_db_client.update_experiment_last_evaluation_job_id(
-                        self.experiment_id, next_evaluation_job_id
-                    )
-                    self.exp_db_client.update_experiment_next_evaluation_job_id(
-                        self.experiment_id, None
-                    )
-                    
+                        update.set('evaluation_workflow_metadata.last_evaluation_job_id', next_evaluation_job_id)
+                        update.set('evaluation_workflow_metadata.next_evaluation_job_id', None)
+
+                if evaluation_state == EvaluationState.EVALUATED:
                     # update latest_train/eval metrics to publish to CW
                     self._update_metrics_from_latest_eval_job(next_evaluation_job_id)
 
@@ -321,12 +344,9 @@ class ExperimentManagerSyncThread(Thread):
                 model_id = predictor.get_hosted_model_id()
                 assert model_id == last_hosted_model_id
             except Exception:
-                self.exp_db_client.update_experiment_hosting_state(
-                    self.experiment_id, None
-                )
-                self.exp_db_client.update_experiment_hosting_endpoint(
-                    self.experiment_id, None
-                )
+                with self.exp_db_client.batch_update(self.experiment_id) as update:
+                    update.set('hosting_workflow_metadata.hosting_state', None)
+                    update.set('hosting_workflow_metadata.hosting_endpoint', None)
                 self.experiment_manager.experiment_record._hosting_state = None
                 self.experiment_manager.experiment_record._hosting_endpoint = None
 
@@ -347,28 +367,22 @@ class ExperimentManagerSyncThread(Thread):
                 hosting_state = HOSTING_ENDPOINT_STATUS_MAP[sm_endpoint_info.get("EndpointStatus")]
 
                 self.experiment_manager.experiment_record._hosting_state = hosting_state
-                # update table states via ddb client
-                self.exp_db_client.update_experiment_hosting_state(
-                    self.experiment_id, hosting_state
-                )
+                # update table states via ddb client, in a single write
+                with self.exp_db_client.batch_update(self.experiment_id) as update:
+                    update.set('hosting_workflow_metadata.hosting_state', hosting_state)
 
-                if hosting_state == HostingState.DEPLOYED:
-                    # update local record
-                    self.experiment_manager.experiment_record._hosting_endpoint = sm_endpoint_info.get("EndpointArn")
-                    self.experiment_manager.experiment_record._last_hosted_model_id = next_model_to_host_id
-                    self.experiment_manager.experiment_record._next_model_to_host_id = None
-                    
-                    # update DynamoDB record
-                    self.exp_db_client.update_experiment_hosting_endpoint(
-                        self.experiment_id, sm_endpoint_info.get("EndpointArn")
-                    )
-                    self.exp_db_client.update_experiment_last_hosted_model_id(
-                        self.experiment_id, next_model_to_host_id
-                    )
-                    self.exp_db_client.update_experiment_next_model_to_host_id(
-                        self.experiment_id, None
-                    )
+                    if hosting_state == HostingState.DEPLOYED:
+                        # update local record
+                        self.experiment_manager.experiment_record._hosting_endpoint = sm_endpoint_info.get("EndpointArn")
+                        self.experiment_manager.experiment_record._last_hosted_model_id = next_model_to_host_id
+                        self.experiment_manager.experiment_record._next_model_to_host_id = None
+
+                        # update DynamoDB record
+                        update.set('hosting_workflow_metadata.hosting_endpoint', sm_endpoint_info.get("EndpointArn"))
+                        update.set('hosting_workflow_metadata.last_hosted_model_id', next_model_to_host_id)
+                        update.set('hosting_workflow_metadata.next_model_to_host_id', None)
 
+                if hosting_state == HostingState.DEPLOYED:
                     self._update_metrics_from_latest_hosting_update(next_model_to_host_id)
             else:
                 # deployment happened on existing endpoint
@@ -392,31 +406,30 @@ class ExperimentManagerSyncThread(Thread):
                         hosting_state = HostingState.DEPLOYING
 
                     self.experiment_manager.experiment_record._hosting_state = hosting_state
-                    # update hosting_state in exp table
-                    self.exp_db_client.update_experiment_hosting_state(
-                        self.experiment_id, hosting_state
-                    )
+                    # update hosting_state in exp table, in a single write
+                    with self.exp_db_client.batch_update(self.experiment_id) as update:
+                        update.set('hosting_workflow_metadata.hosting_state', hosting_state)
+
+                        if hosting_state == HostingState.DEPLOYED:
+                            # update local record
+                            self.experiment_manager.experiment_record._last_hosted_model_id = next_model_to_host_id
+                            self.experiment_manager.experiment_record._next_model_to_host_id = None
+
+                            # update DynamoDB record
+                            update.set('hosting_workflow_metadata.last_hosted_model_id', next_model_to_host_id)
+                            update.set('hosting_workflow_metadata.next_model_to_host_id', None)
 
                     if hosting_state == HostingState.DEPLOYED:
-                        # update local record
-                        self.experiment_manager.experiment_record._last_hosted_model_id = next_model_to_host_id
-                        self.experiment_manager.experiment_record._next_model_to_host_id = None
-                        
-                        # update DynamoDB record
-                        self.exp_db_client.update_experiment_last_hosted_model_id(
-                            self.experiment_id, next_model_to_host_id
-                        )
-                        self.exp_db_client.update_experiment_next_model_to_host_id(
-                            self.experiment_id, None
-                        )
                         self._update_metrics_from_latest_hosting_update(next_model_to_host_id)
 
-    def _update_experiment_db_joining_workflow_metadata(self, joining_workflow_metadata):
+    def _update_experiment_db_joining_workflow_metadata(self, joining_workflow_metadata, join_job_record=None):
         """Update the joining workflow metadata in the experiment table
         
         Args:
             joining_workflow_metadata (dict): A dictionary containing
                 joining workflow related metadata
+            join_job_record (dict): JoinDb record of next_join_job, if
+                already fetched
         """          
         if joining_workflow_metadata is None:
             return
@@ -426,8 +439,9 @@ class ExperimentManagerSyncThread(Thread):
 
         # some joining job request is in progress
         if joining_state is not None and joining_state.endswith("ING"):
-            join_job_record = self.join_db_client.get_join_job_record(
-                self.experiment_id, next_join_job_id)
+            if join_job_record is None:
+                join_job_record = self.join_db_client.get_join_job_record(
+                    self.experiment_id, next_join_job_id)
 
             # if join job record exists in the join table
             if join_job_record is not None:
@@ -439,21 +453,16 @@ class ExperimentManagerSyncThread(Thread):
                     joining_state = current_state
 
                 self.experiment_manager.experiment_record._joining_state = joining_state
-                # update table states via ddb client
-                self.exp_db_client.update_experiment_joining_state(
-                    self.experiment_id, joining_state
-                )
+                # update table states via ddb client, in a single write
+                with self.exp_db_client.batch_update(self.experiment_id) as update:
+                    update.set('joining_workflow_metadata.joining_state', joining_state)
 
-                if joining_state == JoiningState.SUCCEEDED:
-                    self.experiment_manager.experiment_record._last_joined_job_id = next_join_job_id
-                    self.experiment_manager.experiment_record._next_join_job_id = None
+                    if joining_state == JoiningState.SUCCEEDED:
+                        self.experiment_manager.experiment_record._last_joined_job_id = next_join_job_id
+                        self.experiment_manager.experiment_record._next_join_job_id = None
 
-                    self.exp_db_client.update_experiment_last_joined_job_id(
-                        self.experiment_id, next_join_job_id
-                    )
-                    self.exp_db_client.update_experiment_next_join_job_id(
-                        self.experiment_id, None
-                    )
+                        update.set('joining_workflow_metadata.last_joined_job_id', next_join_job_id)
+                        update.set('joining_workflow_metadata.next_join_job_id', None)
 
     def _update_metrics_from_latest_eval_job(self, latest_evaluation_job_id):
         """
@@ -579,90 +588,177 @@ class ExperimentManagerSyncThread(Thread):
         Synchronize ExperimentDb states to local and update
         states of Training/Evaluation and Hosting workflows
 
+        Returns:
+            bool: True if a workflow is still in progress after the sync
         """
         record = self.exp_db_client.get_experiment_record(self.experiment_id)
 
         # sync records to experiment states
         self.experiment_manager.experiment_record = ExperimentRecord.load_from_ddb_record(record)
+        experiment_record = self.experiment_manager.experiment_record
+
+        # ids of the jobs of in-progress workflows
+        training_model_id = None
+        if experiment_record._next_model_to_train_id is not None \
+            and experiment_record._training_state.endswith("ING"):
+            training_model_id = experiment_record._next_model_to_train_id
+        evaluation_model_id = None
+        if experiment_record._next_evaluation_job_id is not None \
+            and experiment_record._evaluation_state.endswith("ING"):
+            evaluation_model_id = experiment_record._next_evaluation_job_id.split('-eval-')[0]
+        join_job_id = None
+        if experiment_record._next_join_job_id is not None \
+            and experiment_record._joining_state.endswith("ING"):
+            join_job_id = experiment_record._next_join_job_id
+
+        # only init the ModelManager()/JoinManager() if the job record already exists,
+        # check all of them in one round trip
+        training_job_record, evaluation_job_record, join_job_record = self._batch_get_job_records(
+            training_model_id if self.experiment_manager.next_model_to_train is None else None,
+            evaluation_model_id if self.experiment_manager.next_model_to_evaluate is None else None,
+            join_job_id if self.experiment_manager.next_join_job is None else None
+        )
 
-        # update training workflow if needed
-        training_workflow_metadata = record.get("training_workflow_metadata", None)
         # first update any in-progress next_model_to_train
-        next_model_to_train_id = self.experiment_manager.experiment_record._next_model_to_train_id
-        training_state = self.experiment_manager.experiment_record._training_state
-        if next_model_to_train_id is not None and training_state.endswith("ING"):
+        if training_model_id is not None:
             if self.experiment_manager.next_model_to_train is not None:
                 self.experiment_manager.next_model_to_train.update_model_training_state()
-            else:
-                # only init the ModelManager() if the training job record already exists
-                if self.model_db_client.get_model_record(self.experiment_id, next_model_to_train_id) is not None:
-                    next_model_to_train = ModelManager(
-                        model_db_client=self.model_db_client,
-                        experiment_id=self.experiment_id,
-                        model_id=next_model_to_train_id)
-                    next_model_to_train.update_model_training_state()
-        time.sleep(1)
-        self._update_experiment_db_training_workflow_metadata(training_workflow_metadata)
+            elif training_job_record is not None:
+                next_model_to_train = ModelManager(
+                    model_db_client=self.model_db_client,
+                    experiment_id=self.experiment_id,
+                    model_id=training_model_id)
+                next_model_to_train.update_model_training_state()
 
-        # update evaluation workflow if needed
-        evaluation_workflow_metadata = record.get("evaluation_workflow_metadata", None)
         # first update any in-progress next_evaluation_job
-        next_evaluation_job_id = self.experiment_manager.experiment_record._next_evaluation_job_id
-        evaluation_state = self.experiment_manager.experiment_record._evaluation_state
-        if next_evaluation_job_id is not None and evaluation_state.endswith("ING"):
+        if evaluation_model_id is not None:
             if self.experiment_manager.next_model_to_evaluate is not None:
                 self.experiment_manager.next_model_to_evaluate.update_model_evaluation_state()
-            else:
-                # only init the ModelManager() if the evaluation job record already exists
-                if self.model_db_client.get_model_record(self.experiment_id, \
-                    next_evaluation_job_id.split('-eval-')[0]) is not None:
-                    next_model_to_evaluate = ModelManager(
-                        model_db_client=self.model_db_client,
-                        experiment_id=self.experiment_id,
-                        model_id=next_evaluation_job_id.split('-eval-')[0])
-                    next_model_to_evaluate.update_model_evaluation_state()
-        time.sleep(1)
-        self._update_experiment_db_evaluation_workflow_metadata(evaluation_workflow_metadata)
+            elif evaluation_job_record is not None:
+                next_model_to_evaluate = ModelManager(
+                    model_db_client=self.model_db_client,
+                    experiment_id=self.experiment_id,
+                    model_id=evaluation_model_id)
+                next_model_to_evaluate.update_model_evaluation_state()
+
+        # first update any in-progress next_join_job
+        if join_job_id is not None:
+            if self.experiment_manager.next_join_job is not None:
+                self.experiment_manager.next_join_job.update_join_job_state()
+            elif join_job_record is not None:
+                next_join_job = JoinManager(
+                    join_db_client=self.join_db_client,
+                    experiment_id=self.experiment_id,
+                    join_job_id=join_job_id)
+                next_join_job.update_join_job_state()
+
+        if training_model_id or evaluation_model_id or join_job_id:
+            time.sleep(1)
+            # read back the updated job records in one round trip
+            training_job_record, evaluation_job_record, join_job_record = self._batch_get_job_records(
+                training_model_id, evaluation_model_id, join_job_id)
+
+        # update training workflow if needed
+        self._update_experiment_db_training_workflow_metadata(
+            record.get("training_workflow_metadata", None), training_job_record)
+
+        # update evaluation workflow if needed
+        self._update_experiment_db_evaluation_workflow_metadata(
+            record.get("evaluation_workflow_metadata", None), evaluation_job_record)
 
         # update hosting workflow if needed
         hosting_workflow_metadata = record.get("hosting_workflow_metadata", None)
         self._update_experiment_db_hosting_workflow_metadata(hosting_workflow_metadata)
 
         # update joining workflow if needed
-        joining_workflow_metadata = record.get("joining_workflow_metadata", None)
-        # first update any in-progress next_join_job
-        next_join_job_id = self.experiment_manager.experiment_record._next_join_job_id
-        joining_state = self.experiment_manager.experiment_record._joining_state
-        if next_join_job_id is not None and joining_state.endswith("ING"):
-            if self.experiment_manager.next_join_job is not None:
-                self.experiment_manager.next_join_job.update_join_job_state()
-            else:
-                # only init the JoinManager() if the join job record already exists
-                if self.join_db_client.get_join_job_record(self.experiment_id, next_join_job_id) is not None:
-                    next_join_job = JoinManager(
-                        join_db_client=self.join_db_client,
-                        experiment_id=self.experiment_id,
-                        join_job_id=next_join_job_id)
-                    next_join_job.update_join_job_state()
-        time.sleep(1)
-        self._update_experiment_db_joining_workflow_metadata(joining_workflow_metadata)
+        self._update_experiment_db_joining_workflow_metadata(
+            record.get("joining_workflow_metadata", None), join_job_record)
 
         self.emit_cloudwatch_metrics_for_training_and_hosting()
 
+        return self.is_workflow_in_flight()
+
+    def _batch_get_job_records(self, training_model_id, evaluation_model_id, join_job_id):
+        """Read the ModelDb/JoinDb records of the given jobs in one round trip
+
+        Args:
+            training_model_id (str): Model id of the training job, or None
+            evaluation_model_id (str): Model id of the evaluation job, or None
+            join_job_id (str): Join job id, or None
+
+        Returns:
+            tuple: The training model record, evaluation model record and join
+            job record. None for ids that are None or records not found.
+        """
+        requests = {}
+        if training_model_id is not None:
+            requests["training"] = (self.model_db_client.table_session,
+                self.model_db_client.model_record_key(self.experiment_id, training_model_id))
+        if evaluation_model_id is not None:
+            requests["evaluation"] = (self.model_db_client.table_session,
+                self.model_db_client.model_record_key(self.experiment_id, evaluation_model_id))
+        if join_job_id is not None:
+            requests["joining"] = (self.join_db_client.table_session,
+                self.join_db_client.join_job_record_key(self.experiment_id, join_job_id))
+
+        records = dict(zip(requests.keys(), self.batch_get_client.batch_get_records(list(requests.values()))))
+        return records.get("training"), records.get("evaluation"), records.get("joining")
+
+    def is_workflow_in_flight(self):
+        """Check if any workflow of the local experiment record is in an
+        'ongoing' (*ING) state
+
+        Returns:
+            bool: True if training, evaluation, hosting or joining is in progress
+        """
+        experiment_record = self.experiment_manager.experiment_record
+        states = [
+            experiment_record._training_state,
+            experiment_record._evaluation_state,
+            experiment_record._hosting_state,
+            experiment_record._joining_state
+        ]
+        return any(state is not None and state.endswith("ING") for state in states)
+
+    def wake(self):
+        """Run the next sync right away instead of waiting for the current interval
+        """
+        self.wake_up.set()
+
     def run(self):
         """
         Start to run the daemon thread for states synchronization
         """
         logger.debug("Starting a daemon thread to sync experiment states")
+        interval = SYNC_ACTIVE_INTERVAL
+        backoff = None
+        woken = True
         while self.thread_running.is_set():
+            self.wake_up.clear()
             try:
-                self.sync_experiment_state_with_ddb()
+                if self.sync_experiment_state_with_ddb() or woken:
+                    # a workflow is in flight, or was just requested and may not be in the table yet
+                    interval = SYNC_ACTIVE_INTERVAL
+                else:
+                    # nothing in flight, slowly go idle
+                    interval = min(interval * 2, SYNC_IDLE_INTERVAL)
+                backoff = None
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in DDB_THROTTLING_ERROR_CODES:
+                    logger.warn("Exception occurred in Experiment Sync Thread: " + str(e))
+                    logger.error(e)
+                    logger.warn("Resuming Sync in 10 seconds...")
+                    interval = 10
+                else:
+                    backoff = min(2 * backoff, SYNC_MAX_BACKOFF) if backoff else SYNC_ACTIVE_INTERVAL
+                    logger.warn(f"Experiment Sync Thread throttled. Resuming Sync in {backoff} seconds...")
+                    interval = backoff
             except Exception as e:
                 logger.warn("Exception occurred in Experiment Sync Thread: " + str(e))
                 logger.error(e)
                 logger.warn("Resuming Sync in 10 seconds...")
-                time.sleep(10)
-            time.sleep(.5)
+                interval = 10
+            woken = self.wake_up.wait(interval)
 
 
 class ExperimentManager():
@@ -787,11 +883,14 @@ class ExperimentManager():
 
     def _sync_experiment_state_with_ddb(self):
         """
-        Synchronize table states into the object states. This method only be
-        invoked in local mode.
+        Synchronize table states into the object states. This method only
+        syncs in local mode, in SageMaker mode it wakes up the sync thread.
         """
         if self.local_mode:
             self.sync_thread.sync_experiment_state_with_ddb()
+        else:
+            # the sync thread may be idle, have it pick up the latest request now
+            self.sync_thread.wake()
 
     def _update_instance_type_for_local_mode(self):
         """Update the instance type if running in 'local' mode
@@ -1027,12 +1126,9 @@ class ExperimentManager():
                 to deploy/update
         """
         # update 'next_model_to_host_id' and 'hosting_state'
-        self.exp_db_client.update_experiment_next_model_to_host_id(
-            self.experiment_id, model_id
-        )
-        self.exp_db_client.update_experiment_hosting_state(
-            self.experiment_id, HostingState.PENDING
-        )
+        with self.exp_db_client.batch_update(self.experiment_id) as update:
+            update.set('hosting_workflow_metadata.next_model_to_host_id', model_id)
+            update.set('hosting_workflow_metadata.hosting_state', HostingState.PENDING)
         # soft deployment will happen once the 'next_model_host_id' is persisted into ExperimentDB
         if not soft_deploy:
             update_endpoint = True
@@ -1156,12 +1252,9 @@ class ExperimentManager():
                 logger.info("No hosting endpoint found, creating a new hosting endpoint.")
 
             # update 'next_model_to_host_id' and 'hosting_state'
-            self.exp_db_client.update_experiment_next_model_to_host_id(
-                self.experiment_id, model_id
-            )
-            self.exp_db_client.update_experiment_hosting_state(
-                self.experiment_id, HostingState.PENDING
-            )
+            with self.exp_db_client.batch_update(self.experiment_id) as update:
+                update.set('hosting_workflow_metadata.next_model_to_host_id', model_id)
+                update.set('hosting_workflow_metadata.hosting_state', HostingState.PENDING)
 
             # starting hosting endpoint
             try:
@@ -1237,13 +1330,22 @@ class ExperimentManager():
 
             return None
 
-    def ingest_rewards(self, rewards_buffer):
+    def ingest_rewards(self, rewards_buffer, compress=True, wait_until_visible=False):
         """Upload rewards data in a rewards buffer to S3 bucket
-        
+
+        The rewards are streamed as newline delimited json into the S3
+        object, gzip compressed by default, so memory and time stay
+        linear in the number of rewards. Large uploads are split into
+        the parts of a multipart upload.
+
         Args:
-            rewards_buffer (list): A list of json blobs containing
-                rewards data
-        
+            rewards_buffer (iterable): A list or generator of json blobs
+                containing rewards data
+            compress (bool): Whether to gzip compress the rewards file
+            wait_until_visible (bool): Whether to wait for the object to be
+                listed. Not needed with S3's read-after-write consistency,
+                only for S3 compatible stores without it.
+
         Returns:
             str: S3 data prefix path that contains the rewards file
         """
@@ -1251,15 +1353,19 @@ class ExperimentManager():
         rewards_bucket_name = self.resource_manager._create_s3_bucket_if_not_exist("sagemaker")
         timstamp = str(int(time.time()))
         rewards_s3_file_key = f"{self.experiment_id}/rewards_data/{self.experiment_id}-{timstamp}/rewards-{timstamp}"
-        body = b''
-
-        for reward in rewards_buffer:
-            body += str(json.dumps(reward) + '\n').encode('utf_8')
+        if compress:
+            # athena picks the compression codec from the file extension
+            rewards_s3_file_key += ".json.gz"
 
+        num_rewards = 0
         try:
-            self.s3_client.put_object(Body=body,
-                                      Bucket=rewards_bucket_name,
-                                      Key=rewards_s3_file_key)
+            with S3StreamWriter(self.s3_client, rewards_bucket_name, rewards_s3_file_key) as s3_writer:
+                stream = gzip.GzipFile(fileobj=s3_writer, mode='wb') if compress else s3_writer
+                for reward in rewards_buffer:
+                    stream.write((json.dumps(reward) + '\n').encode('utf_8'))
+                    num_rewards += 1
+                if compress:
+                    stream.close()
         except ClientError as e:
             error_code = e.response['Error']['Code']
             message = e.response['Error']['Message']
@@ -1269,17 +1375,19 @@ class ExperimentManager():
 
         rewards_file_path = f"s3://{rewards_bucket_name}/{rewards_s3_file_key}"
 
-        logger.info("Waiting for reward data to be uploaded.")
-        waiter = self.s3_client.get_waiter('object_exists')
-        waiter.wait(Bucket=rewards_bucket_name, Key=rewards_s3_file_key)
+        if wait_until_visible:
+            logger.info("Waiting for reward data to be uploaded.")
+            waiter = self.s3_client.get_waiter('object_exists')
+            waiter.wait(Bucket=rewards_bucket_name, Key=rewards_s3_file_key)
 
-        logger.info(f"Successfully upload reward files to s3 bucket path {rewards_file_path}")
+        logger.info(f"Successfully upload {num_rewards} rewards ({s3_writer.bytes_written} bytes) "
+                    f"to s3 bucket path {rewards_file_path}")
 
         reward_s3_prefix = '/'.join(rewards_file_path.split('/')[:-1])
 
         return reward_s3_prefix
 
-    def ingest_joined_data(self, joined_data_buffer, ratio=0.8):
+    def ingest_joined_data(self, joined_data_buffer, ratio=0.8, split_method=SAMPLE_PROB_SPLIT):
         """Upload joined data in joined data buffer to S3 bucket
         
         Args:
@@ -1287,17 +1395,16 @@ class ExperimentManager():
                 joined data
             ratio (float): Split ratio to split data into
                 training data and evaluation data
+            split_method (str): Split on the stored sample_prob or on a
+                reproducible hash of the event_id ("event_id_hash")
         """
         # local join to  simulate a joining workflow
 
         # update next_join_job_id and joining state
         next_join_job_id = JoinManager.name_next_join_job(experiment_id=self.experiment_id)
-        self.exp_db_client.update_experiment_next_join_job_id(
-            self.experiment_id,
-            next_join_job_id)
-        self.exp_db_client.update_experiment_joining_state(
-            self.experiment_id,
-            JoiningState.PENDING)
+        with self.exp_db_client.batch_update(self.experiment_id) as update:
+            update.set('joining_workflow_metadata.next_join_job_id', next_join_job_id)
+            update.set('joining_workflow_metadata.joining_state', JoiningState.PENDING)
 
         self.next_join_job = JoinManager(join_db_client=self.join_db_client,
                                     experiment_id=self.experiment_id,
@@ -1308,7 +1415,8 @@ class ExperimentManager():
     
         logger.info("Started dummy local joining job...")
         self.next_join_job.start_dummy_join(joined_data_buffer=joined_data_buffer,
-                                       ratio=ratio)
+                                       ratio=ratio,
+                                       split_method=split_method)
 
         # this method can be invoked either in local/SM mode
         succeeded_state = self.experiment_record._joining_state == JoiningState.SUCCEEDED \
@@ -1334,7 +1442,9 @@ class ExperimentManager():
                 f"ended with state '{self.experiment_record._joining_state}'. Please check if provided "
                 "joined_data_buffer was in correct data format.")
         
-    def join(self, rewards_s3_path, obs_time_window=None, ratio=0.8, wait=True):
+    def join(self, rewards_s3_path, obs_time_window=None, ratio=0.8, wait=True,
+             local_join=False, obs_data_path=None, split_method=SAMPLE_PROB_SPLIT,
+             joined_data_path=None):
         """Start a joining job given rewards data path and observation
         data time window
         
@@ -1345,6 +1455,18 @@ class ExperimentManager():
             ratio (float): Split ratio used to split training data
                 and evaluation data
             wait (bool): Whether to wait until the joining job finish
+            local_join (bool): Whether to join the data in process instead of
+                with Athena queries. The data paths may then also be local paths.
+            obs_data_path (str): Path of the observation data, defaults to
+                the firehose delivery path of the experiment
+            split_method (str): Split on the stored sample_prob or on a
+                reproducible hash of the event_id ("event_id_hash")
+            joined_data_path (str): S3 or local path a local join writes the
+                joined data under, defaults to the sagemaker-{region}-{account}
+                bucket used by Athena joins
+
+        Raises:
+            Exception: The error of a failed local join
         """
         # Sync experiment state if required
         self._sync_experiment_state_with_ddb()
@@ -1363,15 +1485,15 @@ class ExperimentManager():
 
         # update next_join_job_id and joining state
         next_join_job_id = JoinManager.name_next_join_job(experiment_id=self.experiment_id)
-        self.exp_db_client.update_experiment_next_join_job_id(
-            self.experiment_id,
-            next_join_job_id)
-        self.exp_db_client.update_experiment_joining_state(
-            self.experiment_id,
-            JoiningState.PENDING)
+        with self.exp_db_client.batch_update(self.experiment_id) as update:
+            update.set('joining_workflow_metadata.next_join_job_id', next_join_job_id)
+            update.set('joining_workflow_metadata.joining_state', JoiningState.PENDING)
 
-        input_obs_data_s3_path = f"s3://{self.resource_manager.firehose_bucket}/{self.experiment_id}"
-        input_obs_data_s3_path = f"{input_obs_data_s3_path}/inference_data"
+        if obs_data_path is None:
+            input_obs_data_s3_path = f"s3://{self.resource_manager.firehose_bucket}/{self.experiment_id}"
+            input_obs_data_s3_path = f"{input_obs_data_s3_path}/inference_data"
+        else:
+            input_obs_data_s3_path = obs_data_path
         # init joining job, update join table
         logger.info("Creating resource for joining job...")
 
@@ -1383,13 +1505,20 @@ class ExperimentManager():
                                         obs_start_time=obs_start_time,
                                         obs_end_time=obs_end_time,
                                         input_reward_data_s3_path=rewards_s3_path,
-                                        boto_session=self.boto_session)
+                                        boto_session=self.boto_session,
+                                        local_join=local_join)
 
             logger.info("Started joining job...")
-            self.next_join_job.start_join(ratio=ratio, wait=wait)
+            if local_join:
+                self.next_join_job.start_local_join(ratio=ratio, output_path=joined_data_path,
+                                                    split_method=split_method)
+            else:
+                self.next_join_job.start_join(ratio=ratio, wait=wait, split_method=split_method)
         except Exception as e:
             logger.error(e)
-            pass
+            # a local join has already finished here, waiting for its state won't help
+            if local_join:
+                raise
 
         # wait until exp ddb table updated
         if self.local_mode or wait:
@@ -1440,12 +1569,9 @@ class ExperimentManager():
             # update next_model_to_train_id and training state
             next_model_to_train_id = ModelManager.name_next_model(experiment_id=self.experiment_id)
             logger.info(f"Next Model name would be {next_model_to_train_id}")
-            self.exp_db_client.update_experiment_next_model_to_train_id(
-                self.experiment_id,
-                next_model_to_train_id)
-            self.exp_db_client.update_experiment_training_state(
-                self.experiment_id,
-                TrainingState.PENDING)            
+            with self.exp_db_client.batch_update(self.experiment_id) as update:
+                update.set('training_workflow_metadata.next_model_to_train_id', next_model_to_train_id)
+                update.set('training_workflow_metadata.training_state', TrainingState.PENDING)
             logger.info(f"Start training job for model '{next_model_to_train_id}''")
 
 
@@ -1546,12 +1672,9 @@ class ExperimentManager():
 
             logger.info(f"Starting training job for ModelId '{next_model_to_train_id}''")
 
-            self.exp_db_client.update_experiment_next_model_to_train_id(
-                self.experiment_id,
-                next_model_to_train_id)
-            self.exp_db_client.update_experiment_training_state(
-                self.experiment_id,
-                TrainingState.PENDING)
+            with self.exp_db_client.batch_update(self.experiment_id) as update:
+                update.set('training_workflow_metadata.next_model_to_train_id', next_model_to_train_id)
+                update.set('training_workflow_metadata.training_state', TrainingState.PENDING)
 
             manifest_file_path = None
             if isinstance(input_data_s3_prefix, list):
@@ -1652,13 +1775,9 @@ class ExperimentManager():
 
             logger.info(f"Evaluating model '{evaluate_model_id}' with evaluation job id '{next_evaluation_job_id}'")
 
-            self.exp_db_client.update_experiment_next_evaluation_job_id(
-                self.experiment_id,
-                next_evaluation_job_id)
-
-            self.exp_db_client.update_experiment_evaluation_state(
-                self.experiment_id,
-                EvaluationState.PENDING)
+            with self.exp_db_client.batch_update(self.experiment_id) as update:
+                update.set('evaluation_workflow_metadata.next_evaluation_job_id', next_evaluation_job_id)
+                update.set('evaluation_workflow_metadata.evaluation_state', EvaluationState.PENDING)
 
             manifest_file_path = None
             if isinstance(input_data_s3_prefix, list):
@@ -1797,30 +1916,27 @@ class ExperimentManager():
             experiment_id: A unique id reprenting the experiment
                 to be cleaned up
         """
-        # delete join job records from table
-        join_job_records = self.join_db_client.get_all_join_job_records_of_experiment(
-            experiment_id
+        # delete join job records from table, streaming only their keys
+        join_job_records = self.join_db_client.iter_all_join_job_records_of_experiment(
+            experiment_id, attributes=["join_job_id"]
         )
-
-        if join_job_records:
-            self.join_db_client.batch_delete_items(
-                experiment_id,
-                [record["join_job_id"] for record in join_job_records]
-            )
-
-        # delete model records from table
-        model_records = self.model_db_client.get_all_model_records_of_experiment(
-            experiment_id
+        self.join_db_client.batch_delete_items(
+            experiment_id,
+            (record["join_job_id"] for record in join_job_records)
         )
 
-        if model_records:
-            self.model_db_client.batch_delete_items(
-                experiment_id,
-                [record["model_id"] for record in model_records]
-            )
+        # delete model records from table, streaming only their keys
+        model_records = self.model_db_client.iter_all_model_records_of_experiment(
+            experiment_id, attributes=["model_id"]
+        )
+        self.model_db_client.batch_delete_items(
+            experiment_id,
+            (record["model_id"] for record in model_records)
+        )
 
         # # exit sync thread
         self.sync_thread.thread_running.clear()
+        self.sync_thread.wake()
 
         # delete exp record from table
         self.exp_db_client.delete_item(experiment_id)
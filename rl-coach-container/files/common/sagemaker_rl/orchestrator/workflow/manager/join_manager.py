@@ -6,9 +6,12 @@ import time
 import re
 import json
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Lock, Thread
 from botocore.exceptions import ClientError
 from orchestrator.clients.ddb.join_db_client import JoinDbClient
+from orchestrator.utils.data_split import SAMPLE_PROB_SPLIT, EVENT_ID_HASH_SPLIT, \
+    event_id_hash_bucket_sql, hash_split_threshold, is_train_record, validate_split_method
+from orchestrator.utils.local_join import LocalJoinEngine
 from orchestrator.workflow.datatypes.join_job_record import JoinJobRecord
 from orchestrator.exceptions.ddb_client_exceptions import RecordAlreadyExistsException
 from orchestrator.exceptions.workflow_exceptions import UnhandledWorkflowException, \
@@ -16,12 +19,25 @@ from orchestrator.exceptions.workflow_exceptions import UnhandledWorkflowExcepti
 
 logger = logging.getLogger("orchestrator")
 
+# Partitions registered per ALTER TABLE statement, keeping the statement well
+# below Athena's query string limit, and statements running at the same time
+PARTITIONS_PER_QUERY = 100
+MAX_CONCURRENT_PARTITION_QUERIES = 5
+
 
 class JoinManager:
     """A joining job entity with the given experiment. This class
     will handle the joining job creation and joining job metadata
     management.
     """
+    # partitions already added to each observation table by this process,
+    # so repeated joins over overlapping time windows skip them. The cache is
+    # shared by all instances and keyed by table name only, so it goes stale if
+    # the table is dropped or its partitions are removed outside of this
+    # process. Call clear_registered_partitions() after such changes.
+    _registered_partitions = {}
+    _registered_partitions_lock = Lock()
+
     def __init__(
             self,
             join_db_client: JoinDbClient,
@@ -35,7 +51,8 @@ class JoinManager:
             output_joined_train_data_s3_path=None,
             output_joined_eval_data_s3_path=None,
             join_query_ids=[],
-            boto_session=None):
+            boto_session=None,
+            local_join=False):
         """Initialize a joining job entity in the current experiment
 
         Args:
@@ -58,6 +75,9 @@ class JoinManager:
             join_query_ids (str): Athena join query ids for the joining requests
             boto_session (boto3.session.Session): A session stores configuration
                 state and allows you to create service clients and resources.
+            local_join (bool): Whether the job is joined with a LocalJoinEngine
+                instead of Athena, which needs no Athena client, tables or partitions
+                and no Athena query result bucket
 
         Return:
             orchestrator.join_manager.JoinManager: A ``JoinJob`` object associated
@@ -77,8 +97,13 @@ class JoinManager:
         self.obs_table_non_partitioned = self._formatted_table_name(f"obs-{experiment_id}")
         self.rewards_table = self._formatted_table_name(f"rewards-{experiment_id}")
 
-        self.query_s3_output_bucket = self._create_athena_s3_bucket_if_not_exist()
-        self.athena_client = self.boto_session.client("athena")
+        if local_join:
+            # only created if start_local_join has to default the output path to it
+            self.query_s3_output_bucket = None
+            self.athena_client = None
+        else:
+            self.query_s3_output_bucket = self._create_athena_s3_bucket_if_not_exist()
+            self.athena_client = self.boto_session.client("athena")
 
         # create a local JoinJobRecord object. 
         self.join_job_record = JoinJobRecord(
@@ -94,15 +119,16 @@ class JoinManager:
             join_query_ids
             )
 
-        # create obs partitioned/non-partitioned table if not exists
-        if input_obs_data_s3_path and input_obs_data_s3_path != "local-join-does-not-apply":
-            self._create_obs_table_if_not_exist()
-        # create reward table if not exists
-        if input_reward_data_s3_path and input_reward_data_s3_path != "local-join-does-not-apply":
-            self._create_rewards_table_if_not_exist()
-        # add partitions if input_obs_time_window is not None
-        if obs_start_time and obs_end_time:
-            self._add_time_partitions(obs_start_time, obs_end_time)
+        if not local_join:
+            # create obs partitioned/non-partitioned table if not exists
+            if input_obs_data_s3_path and input_obs_data_s3_path != "local-join-does-not-apply":
+                self._create_obs_table_if_not_exist()
+            # create reward table if not exists
+            if input_reward_data_s3_path and input_reward_data_s3_path != "local-join-does-not-apply":
+                self._create_rewards_table_if_not_exist()
+            # add partitions if input_obs_time_window is not None
+            if obs_start_time and obs_end_time:
+                self._add_time_partitions(obs_start_time, obs_end_time)
 
         # try to save this record file. if it throws RecordAlreadyExistsException 
         # reload the record from JoinJobDb, and recreate
@@ -241,7 +267,24 @@ class JoinManager:
         logger.debug(f"Successfully create observation table "
             f"'{self.obs_table_non_partitioned}' and '{self.obs_table_partitioned}' for query")
 
+    @classmethod
+    def clear_registered_partitions(cls, table_name=None):
+        """Forget the partitions added to an observation table by this process,
+        so the next join adds them again
+
+        Args:
+            table_name (str): Name of the partitioned observation table, all
+                tables if None
+        """
+        with cls._registered_partitions_lock:
+            if table_name is None:
+                cls._registered_partitions.clear()
+            else:
+                cls._registered_partitions.pop(table_name, None)
+
     def _delete_obs_table_if_exist(self):
+        self.clear_registered_partitions(self.obs_table_partitioned)
+
         query_string = f"""
             DROP TABLE IF EXISTS {self.obs_table_partitioned}
         """
@@ -300,6 +343,12 @@ class JoinManager:
     def _add_time_partitions(self, start_time, end_time):
         """Add partitions to Athena table if not exist
 
+        Partitions are added in batches of PARTITIONS_PER_QUERY, with up to
+        MAX_CONCURRENT_PARTITION_QUERIES batches running at the same time.
+        Partitions added before by this process are skipped. If a query of a
+        group fails, the other queries of the group are still waited for and
+        their partitions recorded before the error is raised.
+
         Args:
             start_time (datetime): Datetime object to specify starting time
                 of the observation data
@@ -309,30 +358,57 @@ class JoinManager:
         input_obs_data_s3_path = self.join_job_record.get_input_obs_data_s3_path()
 
         # Adding partitions for each hour
-        partition_string_list  = []
         time_delta = end_time - start_time
         days = time_delta.days
         seconds = time_delta.seconds
         hours = int(days*24 + seconds/3600)
+        partitions = []
         for i in range(hours + 1):
             dt =  start_time + timedelta(hours=i)
             dt_str = dt.strftime("%Y-%m-%d-%H")
             bucket_dt_str = dt.strftime("%Y/%m/%d/%H")
-            partition_string = f"PARTITION (dt = '{dt_str}') LOCATION '{input_obs_data_s3_path}/{bucket_dt_str}/'"
-            partition_string_list.append(partition_string)
+            partitions.append((dt_str, f"{input_obs_data_s3_path}/{bucket_dt_str}/"))
 
-        query_string = f"ALTER TABLE {self.obs_table_partitioned} ADD IF NOT EXISTS"
-        
-        for partition_string in partition_string_list:
-            query_string = f"""
-            {query_string}\n{partition_string}"""
+        with JoinManager._registered_partitions_lock:
+            registered_partitions = JoinManager._registered_partitions.get(self.obs_table_partitioned, set())
+            partitions = [partition for partition in partitions if partition not in registered_partitions]
+        if not partitions:
+            logger.debug(f"All partitions of the time window are in table {self.obs_table_partitioned}")
+            return
 
         s3_output_path = f"s3://{self.query_s3_output_bucket}/{self.experiment_id}/joined_data/partitions"
-        query_id = self._start_query(query_string, s3_output_path)
-        self.wait_query_to_finish(query_id)
-        logger.debug(f"Successfully add partitions to table {self.obs_table_partitioned}")
-
-    def _get_join_query_string(self, ratio=0.8, train_data=True, start_time=None, end_time=None):
+        batches = [partitions[i:i + PARTITIONS_PER_QUERY]
+                   for i in range(0, len(partitions), PARTITIONS_PER_QUERY)]
+        for i in range(0, len(batches), MAX_CONCURRENT_PARTITION_QUERIES):
+            running_batches = []
+            error = None
+            for batch in batches[i:i + MAX_CONCURRENT_PARTITION_QUERIES]:
+                partition_strings = "\n".join(f"PARTITION (dt = '{dt_str}') LOCATION '{location}'"
+                                              for dt_str, location in batch)
+                query_string = f"ALTER TABLE {self.obs_table_partitioned} ADD IF NOT EXISTS\n{partition_strings}"
+                try:
+                    running_batches.append((self._start_query(query_string, s3_output_path), batch))
+                except Exception as e:
+                    error = e
+                    break
+
+            for query_id, batch in running_batches:
+                try:
+                    status = self.wait_query_to_finish(query_id)
+                except Exception as e:
+                    logger.error(f"Failed to add partitions to table {self.obs_table_partitioned}: {e}")
+                    error = error or e
+                    continue
+                if status == 'SUCCEEDED':
+                    with JoinManager._registered_partitions_lock:
+                        JoinManager._registered_partitions.setdefault(
+                            self.obs_table_partitioned, set()).update(batch)
+            if error is not None:
+                raise error
+        logger.debug(f"Successfully add {len(partitions)} partitions to table {self.obs_table_partitioned}")
+
+    def _get_join_query_string(self, ratio=0.8, train_data=True, start_time=None, end_time=None,
+                               split_method=SAMPLE_PROB_SPLIT):
         """return query string with given time range and ratio
 
         Args:
@@ -343,10 +419,47 @@ class JoinManager:
                 of the observation data
             end_time (datetime): Datetime object to specify ending time
                 of the observation data
+            split_method (str): Split on the stored sample_prob or on a hash of
+                the event_id, see orchestrator.utils.data_split
 
         Retrun:
             str: query string for joining
         """
+        query_string_prefix = self._get_joined_table_query_string(start_time, end_time)
+        train_condition = self._get_train_condition_string(ratio, split_method)
+
+        if train_data:
+            query_sample_string = f"SELECT * FROM joined_table WHERE {train_condition}"
+        else:
+            query_sample_string = f"SELECT * FROM joined_table WHERE NOT ({train_condition})"
+        
+        query_string = f"""
+            {query_string_prefix}
+            {query_sample_string}"""
+        
+        return query_string
+
+    def _get_train_condition_string(self, ratio, split_method=SAMPLE_PROB_SPLIT):
+        """return the condition selecting the training data from joined_table
+        """
+        validate_split_method(split_method)
+        if split_method == EVENT_ID_HASH_SPLIT:
+            hash_bucket = event_id_hash_bucket_sql("joined_table.event_id")
+            return f"{hash_bucket} < {hash_split_threshold(ratio)}"
+        return f"joined_table.sample_prob <= {ratio}"
+
+    def _get_joined_table_query_string(self, start_time=None, end_time=None):
+        """return the WITH clause defining joined_table for the given time range
+
+        Args:
+            start_time (datetime): Datetime object to specify starting time
+                of the observation data
+            end_time (datetime): Datetime object to specify ending time
+                of the observation data
+
+        Retrun:
+            str: query string of the joined_table
+        """
         if start_time is not None:
             start_time_str = start_time.strftime("%Y-%m-%d-%H")
         if end_time is not None:
@@ -385,16 +498,7 @@ class JoinManager:
                         ON {self.rewards_table}.event_id=obs_table.event_id
                     )"""
 
-        if train_data:
-            query_sample_string = f"SELECT * FROM joined_table WHERE joined_table.sample_prob <= {ratio}"
-        else:
-            query_sample_string = f"SELECT * FROM joined_table WHERE joined_table.sample_prob > {ratio}"
-        
-        query_string = f"""
-            {query_string_prefix}
-            {query_sample_string}"""
-        
-        return query_string
+        return query_string_prefix
         
     def _start_query(self, query_string, s3_output_path):
         """Start query with given query string and output path
@@ -428,6 +532,9 @@ class JoinManager:
 
         Args:
             query_id (str): query id of Athena query
+
+        Return:
+            str: Final status of the query
         """
         status = 'QUEUED'
         while status == 'RUNNING' or status == 'QUEUED':
@@ -450,7 +557,8 @@ class JoinManager:
         elif status == 'CANCELLED':
             logger.warning("Query was cancelled...")
         elif status == 'SUCCEEDED':
-            logger.debug("Query finished successfully")    
+            logger.debug("Query finished successfully")
+        return status
 
     def get_query_status(self, query_id):
         """Return query status given query ID
@@ -474,48 +582,117 @@ class JoinManager:
             ))
         return status
         
-    def start_join(self, ratio=0.8, wait=True):
+    def start_join(self, ratio=0.8, wait=True, split_method=SAMPLE_PROB_SPLIT):
         """Start Athena queries for the joining
 
         Args:
             ratio (float): Split ratio for training and evaluation data set
             wait (bool): Whether the call should wait until the joining completes.
+            split_method (str): Split on the stored sample_prob or on a hash of
+                the event_id, see orchestrator.utils.data_split
 
         """
         logger.info(f"Splitting data into train/evaluation set with ratio of {ratio}")
 
         obs_start_time, obs_end_time = self.join_job_record.get_obs_start_end_time()
 
-        join_query_for_train_data = self._get_join_query_string(ratio=ratio, 
-            train_data=True, start_time=obs_start_time, end_time=obs_end_time)
-        join_query_for_eval_data = self._get_join_query_string(ratio=ratio, 
-            train_data=False, start_time=obs_start_time, end_time=obs_end_time)
-
         s3_output_path = f"s3://{self.query_s3_output_bucket}/" \
                 f"{self.experiment_id}/joined_data/{self.join_job_id}"
         logger.info(f"Joined data will be stored under {s3_output_path}")
 
-
-        join_query_id_for_train = self._start_query(join_query_for_train_data, f"{s3_output_path}/train")
-        join_query_id_for_eval = self._start_query(join_query_for_eval_data, f"{s3_output_path}/eval")
+        join_query_for_train_data = self._get_join_query_string(ratio=ratio,
+            train_data=True, start_time=obs_start_time, end_time=obs_end_time,
+            split_method=split_method)
+        join_query_for_eval_data = self._get_join_query_string(ratio=ratio,
+            train_data=False, start_time=obs_start_time, end_time=obs_end_time,
+            split_method=split_method)
+        train_data_s3_path = f"{s3_output_path}/train"
+        eval_data_s3_path = f"{s3_output_path}/eval"
+        join_query_ids = [self._start_query(join_query_for_train_data, train_data_s3_path),
+                          self._start_query(join_query_for_eval_data, eval_data_s3_path)]
 
         # updates join table states vid ddb client
         self.join_db_client.update_join_job_current_state(
             self.experiment_id, self.join_job_id, 'PENDING'
         )
         self.join_db_client.update_join_job_output_joined_train_data_s3_path(
-            self.experiment_id, self.join_job_id, f"{s3_output_path}/train"
+            self.experiment_id, self.join_job_id, train_data_s3_path
         )
         self.join_db_client.update_join_job_output_joined_eval_data_s3_path(
-            self.experiment_id, self.join_job_id, f"{s3_output_path}/eval"
+            self.experiment_id, self.join_job_id, eval_data_s3_path
         )
         self.join_db_client.update_join_job_join_query_ids(
-            self.experiment_id, self.join_job_id, [join_query_id_for_train, join_query_id_for_eval]
+            self.experiment_id, self.join_job_id, join_query_ids
         )
 
         if wait:
-            self.wait_query_to_finish(join_query_id_for_train)
-            self.wait_query_to_finish(join_query_id_for_eval)
+            for query_id in join_query_ids:
+                self.wait_query_to_finish(query_id)
+
+    def start_local_join(self, ratio=0.8, output_path=None, s3_client=None, split_method=SAMPLE_PROB_SPLIT):
+        """Join the observation and reward data in process with a
+        LocalJoinEngine instead of Athena queries. The input paths may be
+        S3 paths, also of an S3 compatible store like MinIO, or local paths.
+
+        Args:
+            ratio (float): Split ratio for training and evaluation data set
+            output_path (str): S3 or local path to store the joined data under,
+                defaults to the path used by Athena joins, in the
+                sagemaker-{region}-{account} bucket which is created if needed
+            s3_client (botocore.client.S3): Client for S3 paths, defaults to
+                a client of the boto session
+            split_method (str): Split on the stored sample_prob or on a hash of
+                the event_id, see orchestrator.utils.data_split
+
+        Raises:
+            Exception: The error of the join, after the job is marked as FAILED
+        """
+        logger.info(f"Splitting data into train/evaluation set with ratio of {ratio}")
+
+        obs_start_time, obs_end_time = self.join_job_record.get_obs_start_end_time()
+
+        if output_path is None:
+            if self.query_s3_output_bucket is None:
+                self.query_s3_output_bucket = self._create_athena_s3_bucket_if_not_exist()
+            output_path = f"s3://{self.query_s3_output_bucket}/" \
+                f"{self.experiment_id}/joined_data/{self.join_job_id}"
+        output_path = output_path.rstrip('/')
+        logger.info(f"Joined data will be stored under {output_path}")
+
+        # a RUNNING job without query ids is not polled against Athena
+        self.join_db_client.update_join_job_current_state(
+            self.experiment_id, self.join_job_id, 'RUNNING'
+        )
+        self.join_db_client.update_join_job_output_joined_train_data_s3_path(
+            self.experiment_id, self.join_job_id, f"{output_path}/train"
+        )
+        self.join_db_client.update_join_job_output_joined_eval_data_s3_path(
+            self.experiment_id, self.join_job_id, f"{output_path}/eval"
+        )
+
+        if s3_client is None:
+            s3_client = self.boto_session.client("s3")
+        join_engine = LocalJoinEngine(s3_client)
+        try:
+            join_engine.join(
+                self.join_job_record.get_input_obs_data_s3_path(),
+                self.join_job_record.get_input_reward_data_s3_path(),
+                f"{output_path}/train",
+                f"{output_path}/eval",
+                ratio=ratio,
+                start_time=obs_start_time,
+                end_time=obs_end_time,
+                split_method=split_method)
+        except Exception as e:
+            logger.error(f"Local joining job '{self.join_job_id}' failed: {e}")
+            self.join_db_client.update_join_job_current_state(
+                self.experiment_id, self.join_job_id, "FAILED"
+            )
+            raise
+
+        self.join_db_client.update_join_job_current_state(
+            self.experiment_id, self.join_job_id, "SUCCEEDED"
+        )
 
     def _val_list_to_csv_byte_string(self, val_list):
         """Convert a list of variables into string in csv format
@@ -577,12 +754,14 @@ class JoinManager:
 
         return joined_data_file_path
 
-    def start_dummy_join(self, joined_data_buffer, ratio=0.8):
+    def start_dummy_join(self, joined_data_buffer, ratio=0.8, split_method=SAMPLE_PROB_SPLIT):
         """Start a dummy joining job with the given joined data buffer
 
         Args:
             joined_data_buffer (list): A list of json blobs containing joined data points
             ratio (float): Split ratio for training and evaluation data set
+            split_method (str): Split on the stored sample_prob or on a hash of
+                the event_id, see orchestrator.utils.data_split
 
         """
         logger.info(f"Splitting data into train/evaluation set with ratio of {ratio}")
@@ -590,8 +769,9 @@ class JoinManager:
         joined_train_data_buffer = []
         joined_eval_data_buffer = []
 
+        validate_split_method(split_method)
         for record in joined_data_buffer:
-            if record["sample_prob"] <= ratio:
+            if is_train_record(record, ratio, split_method):
                 joined_train_data_buffer.append(record)
             else:
                 joined_eval_data_buffer.append(record)
@@ -673,6 +853,9 @@ class JoinManager:
             return
 
         if not join_query_ids:
+            if current_state == 'RUNNING':
+                # local joins update their state themselves
+                return
             raise JoinQueryIdsNotAvailableException(f"Query ids for Joining job "
             f"'{self.join_job_id}' cannot be found.")
 
@@ -681,8 +864,8 @@ class JoinManager:
         for query_id in join_query_ids:
             query_states.append(self.get_query_status(query_id))
 
-        # only 'SUCCEEDED' if both queries are 'SUCCEEDED'
-        if query_states[0] == 'SUCCEEDED' and query_states[1] == 'SUCCEEDED':
+        # only 'SUCCEEDED' if all queries are 'SUCCEEDED'
+        if all(query_state == 'SUCCEEDED' for query_state in query_states):
             current_state = 'SUCCEEDED'
         elif 'FAILED' in query_states:
             current_state = 'FAILED'
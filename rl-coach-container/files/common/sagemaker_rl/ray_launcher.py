@@ -1,8 +1,13 @@
+import inspect
 import json
+import logging
 import os
+import re
+import socket
 import subprocess
 import sys
 import time
+from functools import lru_cache
 from shutil import copyfile
 from enum import Enum
 
@@ -10,15 +15,97 @@ import boto3
 
 import ray
 from ray.tune import run_experiments
-from .tf_serving_utils import export_tf_serving, natural_keys, change_permissions_recursive
+from .tf_serving_utils import export_tf_serving, export_policy_from_checkpoint, export_onnx_from_saved_model, \
+    checkpoint_has_worker_state, change_permissions_recursive
+from .checkpoint_index import CheckpointIndex, LEGACY_REQUIRED_METADATA
 from .configuration_list import ConfigurationList
 from .sage_cluster_communicator import SageClusterCommunicator
-from .docker_utils import get_ip_from_host
+from .docker_utils import get_ip_from_host, get_container_cpu_limit, get_container_memory_limit, get_shm_size
+
+logger = logging.getLogger(__name__)
 
 TERMINATION_SIGNAL = "JOB_TERMINATED"
 INTERMEDIATE_DIR = "/opt/ml/output/intermediate"
 CHECKPOINT_DIR = "/opt/ml/input/data/checkpoint"
 MODEL_OUTPUT_DIR = "/opt/ml/model"
+RAY_HEAD_PORT = 6379
+RAY_STARTUP_TIMEOUT = 60
+SHM_DIR = "/dev/shm"
+# Share of the container memory given to the Ray object store, and the smallest store Ray accepts.
+OBJECT_STORE_MEMORY_FRACTION = 0.3
+MIN_OBJECT_STORE_MEMORY = 75 * 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def ray_start_options():
+    """Returns the long options accepted by the installed ``ray start`` CLI.
+    Used instead of comparing ``ray.__version__`` strings to pick the right flags.
+    Raises if the CLI can't be queried, rather than guessing flags of an unknown version.
+    """
+    try:
+        result = subprocess.run(["ray", "start", "--help"], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise RuntimeError("Could not run `ray start --help` to detect the Ray CLI options: %s" % e)
+    options = frozenset(re.findall(r"--[a-z][a-z0-9-]*", result.stdout))
+    if result.returncode != 0 or "--head" not in options:
+        raise RuntimeError("Could not detect the Ray CLI options, `ray start --help` exited with code %s:\n%s"
+                           % (result.returncode, result.stdout))
+    return options
+
+
+def ray_init_address_key():
+    """Returns the keyword ``ray.init`` uses for the address of an existing cluster.
+    """
+    if "address" in inspect.signature(ray.init).parameters:
+        return "address"
+    return "redis_address"
+
+
+def ray_init_kwargs(resources):
+    """Maps resource settings onto the keywords the installed ``ray.init`` accepts,
+    e.g. ``plasma_directory`` became ``_plasma_directory`` in later releases.
+    """
+    parameters = inspect.signature(ray.init).parameters
+    kwargs = {}
+    for name, value in resources.items():
+        if name in parameters:
+            kwargs[name] = value
+        elif "_%s" % name in parameters:
+            kwargs["_%s" % name] = value
+    return kwargs
+
+
+def ray_start_resource_args(resources):
+    """Maps resource settings onto the ``ray start`` flags the installed CLI accepts.
+    """
+    options = ray_start_options()
+    args = []
+    for name, value in resources.items():
+        flag = "--%s" % name.replace("_", "-")
+        if flag in options:
+            args.append("%s=%s" % (flag, value))
+    return args
+
+
+def checkpoint_recording_callbacks(checkpoint_index):
+    """Returns Tune callbacks that add every checkpoint to ``checkpoint_index`` as Tune writes it,
+    or None if the installed Tune doesn't support callbacks.
+    """
+    if "callbacks" not in inspect.signature(run_experiments).parameters:
+        return None
+    from ray.tune import Callback
+
+    class CheckpointRecorder(Callback):
+        def on_checkpoint(self, iteration, trials, trial, checkpoint, **info):
+            # the attribute holding the checkpoint path differs between Ray releases
+            for attribute in ("value", "dir_or_data", "path"):
+                path = getattr(checkpoint, attribute, None)
+                if isinstance(path, str):
+                    checkpoint_index.record_checkpoint(path)
+                    return
+
+    return [CheckpointRecorder()]
 
 
 class Cluster(Enum):
@@ -70,8 +157,15 @@ class SageMakerRayLauncher(object):
         self.host_name = os.environ.get("SM_CURRENT_HOST", "algo-1")
         self.hosts_info = json.loads(os.environ.get("SM_RESOURCE_CONFIG"))["hosts"]
         self.is_master_node = self.hosts_info[0] == self.host_name and self.cluster_type == Cluster.Primary
+        # Set with the `rl_export_onnx` hyperparameter. Like `rl_cluster_type` it has no dot, so
+        # customize_experiment_config doesn't merge it into the experiment config.
+        self.export_onnx = os.environ.get("SM_HP_RL_EXPORT_ONNX", "false").lower() in ("1", "true")
 
         self.sage_cluster_communicator = SageClusterCommunicator()
+        if ray.__version__ >= "0.6.5":
+            self.checkpoint_index = CheckpointIndex(INTERMEDIATE_DIR)
+        else:
+            self.checkpoint_index = CheckpointIndex(INTERMEDIATE_DIR, LEGACY_REQUIRED_METADATA)
 
     def _get_cluster_type(self):
         cluster_str = os.environ.get("SM_HP_RL_CLUSTER_TYPE", "primary")
@@ -121,9 +215,45 @@ class SageMakerRayLauncher(object):
             all_workers_host_names.append("%s:algo-%s" % (Cluster.Secondary.value, i + 1))
         return all_workers_host_names
 
+    def get_ray_resources(self):
+        """Sizes CPUs, GPUs and the object store from the container's cgroup limits and /dev/shm,
+        so that rollout workers do not oversubscribe the CPU quota and the object store fits in
+        shared memory instead of spilling.
+        """
+        cpu_limit = get_container_cpu_limit()
+        num_cpus = max(self.num_cpus, 3)
+        if cpu_limit < num_cpus:
+            num_cpus = max(int(cpu_limit), 1)
+
+        num_gpus = self.num_gpus
+        visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        if visible_devices is not None:
+            num_gpus = min(num_gpus, len([d for d in visible_devices.split(",") if d.strip()]))
+
+        memory_limit = get_container_memory_limit()
+        shm_size = get_shm_size(SHM_DIR)
+        object_store_memory = max(int(memory_limit * OBJECT_STORE_MEMORY_FRACTION), MIN_OBJECT_STORE_MEMORY)
+        # Leave some headroom in /dev/shm for other users of shared memory (e.g. torch/tf).
+        usable_shm = int(shm_size * 0.9)
+        if usable_shm >= MIN_OBJECT_STORE_MEMORY:
+            plasma_directory = SHM_DIR
+            object_store_memory = min(object_store_memory, usable_shm)
+        else:
+            plasma_directory = "/tmp"
+            print("Warning: %s has only %s bytes free. The Ray object store will be file-backed in /tmp. "
+                  "Increase the container --shm-size for better performance." % (SHM_DIR, shm_size))
+
+        resources = {"num_cpus": num_cpus,
+                     "num_gpus": num_gpus,
+                     "object_store_memory": object_store_memory,
+                     "plasma_directory": plasma_directory}
+        print("Ray resources: %s (cgroup cpu limit: %.2f, memory limit: %s bytes, %s free: %s bytes)"
+              % (resources, cpu_limit, memory_limit, SHM_DIR, shm_size))
+        return resources
+
     def ray_init_config(self):
-        num_workers = max(self.num_cpus, 3)
-        config = {"num_cpus": num_workers, "num_gpus": self.num_gpus}
+        resources = self.get_ray_resources()
+        config = ray_init_kwargs(resources)
 
         if self.is_master_node:
             all_wokers_host_names = self.get_all_host_names()[1:]
@@ -131,24 +261,23 @@ class SageMakerRayLauncher(object):
             if len(all_wokers_host_names) == 0:
                 return config
             master_ip = get_ip_from_host(host_name=self.host_name)
-            self.start_ray_cluster(master_ip)
+            # Publish the host config while the head node is still coming up.
+            p = self._launch_ray_head(master_ip, resources)
             self.sage_cluster_communicator.write_host_config(ip=master_ip,
                                                              host_name="%s:%s" % (
                                                              self.cluster_type.value, self.host_name))
+            self._wait_for_ray_head(master_ip, process=p)
             self.sage_cluster_communicator.create_s3_signal("%s:%s" % (self.cluster_type.value, self.host_name))
             print("Waiting for %s worker nodes to join!" % (len(all_wokers_host_names)))
             self.sage_cluster_communicator.wait_for_signals(all_wokers_host_names)
             print("All worker nodes have joined the cluster. Now training...")
-            if ray.__version__ >= "0.8.2":
-                config = {"address": "%s:6379" % master_ip}
-            else:
-                config = {"redis_address": "%s:6379" % master_ip}
+            config = {ray_init_address_key(): "%s:%s" % (master_ip, RAY_HEAD_PORT)}
         else:
             master_ip, master_hostname = self.sage_cluster_communicator.get_master_config()
             node_ip = get_ip_from_host(host_name=self.host_name)
             self.sage_cluster_communicator.wait_for_signals([master_hostname])
             print("Attempting to join ray cluster.")
-            self.join_ray_cluster(master_ip, node_ip)
+            self.join_ray_cluster(master_ip, node_ip, resources)
             self.sage_cluster_communicator.create_s3_signal("%s:%s" % (self.cluster_type.value, self.host_name))
             print("Joined ray cluster at %s successfully!" % master_ip)
             self.sage_cluster_communicator.wait_for_signals([TERMINATION_SIGNAL], timeout=sys.maxsize)
@@ -156,60 +285,87 @@ class SageMakerRayLauncher(object):
 
         return config
 
-    def start_ray_cluster(self, master_ip):
-        if ray.__version__ >= "0.6.5":
-            p = subprocess.Popen("ray start --head --redis-port=6379 --node-ip-address=%s" % master_ip,
-                                 shell=True,
-                                 stderr=subprocess.STDOUT)
+    def start_ray_cluster(self, master_ip, resources=None):
+        p = self._launch_ray_head(master_ip, resources)
+        self._wait_for_ray_head(master_ip, process=p)
+
+    def _launch_ray_head(self, master_ip, resources=None):
+        options = ray_start_options()
+        cmd = ["ray", "start", "--head", "--node-ip-address=%s" % master_ip]
+        if "--port" in options:
+            cmd.append("--port=%s" % RAY_HEAD_PORT)
         else:
-            p = subprocess.Popen("ray start --head --redis-port=6379 --no-ui --node-ip-address=%s" % master_ip,
-                                 shell=True,
-                                 stderr=subprocess.STDOUT)
-
-        time.sleep(3)
-        if p.poll() != 0:
-            raise RuntimeError("Could not start Ray server.")
-
-    def join_ray_cluster(self, master_ip, node_ip):
-        if ray.__version__ >= "0.8.2":
-            p = subprocess.Popen("ray start --address=%s:6379" % (master_ip),
-                             shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+            cmd.append("--redis-port=%s" % RAY_HEAD_PORT)
+        # The web UI is not reachable inside the training container, don't start it.
+        if "--no-ui" in options:
+            cmd.append("--no-ui")
+        elif "--include-dashboard" in options:
+            cmd.append("--include-dashboard=false")
+        cmd.extend(ray_start_resource_args(resources or {}))
+        print("Starting Ray head node: %s" % " ".join(cmd))
+        return subprocess.Popen(cmd, stderr=subprocess.STDOUT)
+
+    def _wait_for_ray_head(self, master_ip, process=None, timeout=RAY_STARTUP_TIMEOUT):
+        """Polls the Ray head (GCS/Redis) port with exponential backoff until it accepts connections.
+        Fails fast if the `ray start` process that should bring it up has already exited with an error.
+        """
+        deadline = time.time() + timeout
+        delay = 0.1
+        while True:
+            try:
+                with socket.create_connection((master_ip, RAY_HEAD_PORT), timeout=1):
+                    print("Ray head is reachable at %s:%s" % (master_ip, RAY_HEAD_PORT))
+                    return
+            except OSError:
+                pass
+            if process is not None and process.poll() not in (None, 0):
+                raise RuntimeError("Could not start Ray server: `ray start` exited with code %s."
+                                   % process.returncode)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError("Ray server at %s:%s was not reachable after %s seconds."
+                                   % (master_ip, RAY_HEAD_PORT, timeout))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 5)
+
+    def join_ray_cluster(self, master_ip, node_ip, resources=None):
+        self._wait_for_ray_head(master_ip)
+        if "--address" in ray_start_options():
+            cmd = ["ray", "start", "--address=%s:%s" % (master_ip, RAY_HEAD_PORT)]
         else:
-            p = subprocess.Popen("ray start --redis-address=%s:6379 --node-ip-address=%s" % (master_ip, node_ip),
-                                shell=True, stderr=subprocess.STDOUT)
-        time.sleep(3)
-        if p.poll() != 0:
-            raise RuntimeError("Could not join Ray server running at %s:6379" % master_ip)
+            cmd = ["ray", "start", "--redis-address=%s:%s" % (master_ip, RAY_HEAD_PORT),
+                   "--node-ip-address=%s" % node_ip]
+        cmd.extend(ray_start_resource_args(resources or {}))
+        p = subprocess.Popen(cmd, stderr=subprocess.STDOUT)
+        try:
+            return_code = p.wait(timeout=RAY_STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            raise RuntimeError("Timed out joining Ray server running at %s:%s" % (master_ip, RAY_HEAD_PORT))
+        if return_code != 0:
+            raise RuntimeError("Could not join Ray server running at %s:%s" % (master_ip, RAY_HEAD_PORT))
 
     def copy_checkpoints_to_model_output(self):
-        checkpoints = []
-        count = 0
-        while not checkpoints:
-            count += 1
-            for root, directories, filenames in os.walk(INTERMEDIATE_DIR):
-                for filename in filenames:
-                    if filename.startswith("checkpoint"):
-                        checkpoints.append(os.path.join(root, filename))
+        # Checkpoints recorded during training make the scan unnecessary. It is only needed
+        # with Ray releases whose Tune has no callbacks.
+        for attempt in range(6):
+            latest_checkpoint = self.checkpoint_index.latest_complete()
+            if latest_checkpoint is not None:
+                break
+            self.checkpoint_index.refresh()
+            latest_checkpoint = self.checkpoint_index.latest_complete()
+            if latest_checkpoint is not None:
+                break
             time.sleep(5)
-            if count >= 6:
-                raise RuntimeError("Failed to find checkpoint files")
-
-        checkpoints.sort(key=natural_keys)
-        latest_checkpoints = checkpoints[-2:]
-        validation = sum(1 if x.endswith("tune_metadata") or x.endswith("extra_data") else 0 for x in
-                         latest_checkpoints)
-
-        if ray.__version__ >= "0.6.5":
-            if validation is not 1:
-                raise RuntimeError("Failed to save checkpoint files - .tune_metadata")
         else:
-            if validation is not 2:
-                raise RuntimeError("Failed to save checkpoint files - .tune_metadata or .extra_data")
-
-        for source_path in latest_checkpoints:
-            _, ext = os.path.splitext(source_path)
-            destination_path = os.path.join(MODEL_OUTPUT_DIR, "checkpoint%s" % ext)
-            copyfile(source_path, destination_path)
+            latest_checkpoint = self.checkpoint_index.latest()
+            if latest_checkpoint is not None:
+                raise RuntimeError("Failed to save checkpoint files - %s missing in %s"
+                                   % (", ".join(latest_checkpoint.missing_files), latest_checkpoint.directory))
+            raise RuntimeError("Failed to find checkpoint files in %s" % self.checkpoint_index.root_dir)
+
+        print("Latest checkpoint is iteration %s in %s" % (latest_checkpoint.iteration, latest_checkpoint.trial_dir))
+        for source_path, destination_path in self.checkpoint_index.copy_latest(MODEL_OUTPUT_DIR):
             print("Saved the checkpoint file %s as %s" % (source_path, destination_path))
 
     def save_experiment_config(self):
@@ -225,6 +381,39 @@ class SageMakerRayLauncher(object):
         copyfile(source, os.path.join(MODEL_OUTPUT_DIR, "params.json"))
         print("Saved model configuration.")
 
+    def get_policy_spaces(self, config, env_string):
+        """Returns the (observation_space, action_space) of the policy to export.
+        Creates a single environment instance to read them. Sub-classes that know their
+        spaces can override this to skip environment creation entirely.
+        """
+        from ray.tune.registry import ENV_CREATOR, _global_registry
+        from ray.rllib.env.env_context import EnvContext
+        env_creator = _global_registry.get(ENV_CREATOR, env_string)
+        env = env_creator(EnvContext(config.get("env_config", {}), worker_index=0))
+        try:
+            return env.observation_space, env.action_space
+        finally:
+            if hasattr(env, "close"):
+                env.close()
+
+    def _can_export_policy_from_checkpoint(self, cls, checkpoint):
+        """Whether the trainer class and checkpoint provide what ``_export_policy_from_checkpoint``
+        needs: the policy class, the trainer config merging and the rollout worker state.
+        """
+        if not all(hasattr(cls, name) for name in ("_policy", "merge_trainer_configs", "_default_config")):
+            return False
+        return checkpoint_has_worker_state(checkpoint)
+
+    def _export_policy_from_checkpoint(self, cls, config, env_string, checkpoint):
+        from ray.rllib.models import ModelCatalog
+        policy_cls = cls._policy
+        config = cls.merge_trainer_configs(cls._default_config, config)
+        observation_space, action_space = self.get_policy_spaces(config, env_string)
+        # Policies see the preprocessed observation space, as they do inside a rollout worker.
+        preprocessor = ModelCatalog.get_preprocessor_for_space(observation_space, config.get("model"))
+        export_policy_from_checkpoint(policy_cls, preprocessor.observation_space, action_space, config,
+                                      checkpoint, MODEL_OUTPUT_DIR)
+
     def create_tf_serving_model(self, algorithm=None, env_string=None):
         self.register_env_creator()
         if ray.__version__ >= "0.6.5":
@@ -236,12 +425,21 @@ class SageMakerRayLauncher(object):
             config = json.load(config_json)
         print("Loaded config for TensorFlow serving.")
         config["monitor"] = False
-        config["num_workers"] = 1
+        config["num_workers"] = 0
         config["num_gpus"] = 0
-        agent = cls(env=env_string, config=config)
         checkpoint = os.path.join(MODEL_OUTPUT_DIR, "checkpoint")
-        agent.restore(checkpoint)
-        export_tf_serving(agent, MODEL_OUTPUT_DIR)
+        if self._can_export_policy_from_checkpoint(cls, checkpoint):
+            self._export_policy_from_checkpoint(cls, config, env_string, checkpoint)
+        else:
+            # Older RLlib releases lack the policy/checkpoint APIs used by the direct export.
+            logger.warning("This RLlib release can't export the policy directly from the checkpoint. "
+                           "Restoring the full agent instead.")
+            agent = cls(env=env_string, config=config)
+            agent.restore(checkpoint)
+            export_tf_serving(agent, MODEL_OUTPUT_DIR)
+        if self.export_onnx:
+            export_onnx_from_saved_model(os.path.join(MODEL_OUTPUT_DIR, "1"),
+                                         os.path.join(MODEL_OUTPUT_DIR, "model.onnx"))
 
     def save_checkpoint_and_serving_model(self, algorithm=None, env_string=None):
         self.save_experiment_config()
@@ -327,7 +525,11 @@ class SageMakerRayLauncher(object):
               "experiment is actually restored successfully. If restoration is expected, please check",
               "\"training_iteration\" in the experiment info to confirm."
              )
-        run_experiments(experiment_config)
+        callbacks = checkpoint_recording_callbacks(self.checkpoint_index)
+        if callbacks is not None:
+            run_experiments(experiment_config, callbacks=callbacks)
+        else:
+            run_experiments(experiment_config)
         all_wokers_host_names = self.get_all_host_names()[1:]
         # If distributed job, send TERMINATION_SIGNAL to all workers.
         if len(all_wokers_host_names) > 0:
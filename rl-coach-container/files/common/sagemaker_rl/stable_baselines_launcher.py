@@ -1,15 +1,25 @@
 import gym
+import json
+import logging
+import math
+import numpy as np
 import roboschool
 import os
+import queue
+import threading
 
-from gym.wrappers.monitoring.video_recorder import VideoRecorder
+from gym.wrappers.monitoring.video_recorder import ImageEncoder
 from stable_baselines.ppo1 import PPO1
+from stable_baselines.ppo2 import PPO2
 from stable_baselines.common import set_global_seeds
 from stable_baselines.bench import Monitor
 from stable_baselines.common import tf_util
 from stable_baselines.common.policies import MlpPolicy
+from stable_baselines.common.vec_env import VecEnv, VecEnvWrapper, DummyVecEnv, SubprocVecEnv
 from mpi4py import MPI
 
+logger = logging.getLogger(__name__)
+
 
 class RewScale(gym.RewardWrapper):
     def __init__(self, env, scale):
@@ -20,6 +30,70 @@ class RewScale(gym.RewardWrapper):
         return _reward * self.scale
 
 
+class VecRewScale(VecEnvWrapper):
+    """
+    Scales the rewards of every sub-environment of a VecEnv with a single array operation.
+    """
+
+    def __init__(self, venv, scale):
+        VecEnvWrapper.__init__(self, venv)
+        self.scale = scale
+
+    def reset(self):
+        return self.venv.reset()
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+        return obs, np.asarray(rewards) * self.scale, dones, infos
+
+
+class AsyncVideoWriter(object):
+    """
+    Encodes rgb frames into a video on a background thread.
+
+    Frames are handed over through a bounded queue, so the producer only blocks when the encoder
+    falls more than ``max_queued_frames`` behind.
+    """
+
+    def __init__(self, path, frames_per_sec, max_queued_frames=64):
+        self.path = path
+        self.frames_per_sec = frames_per_sec
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queued_frames)
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+
+    def write(self, frame):
+        self._queue.put(frame)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            logger.error("Failed to encode video %s: %s", self.path, self.error, exc_info=self.error)
+
+    def _encode(self):
+        encoder = None
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # Keep draining so the producer never blocks on a dead encoder.
+                continue
+            try:
+                if encoder is None:
+                    encoder = ImageEncoder(self.path, frame.shape, self.frames_per_sec)
+                encoder.capture_frame(frame)
+            except Exception as e:
+                self.error = e
+        if encoder is not None:
+            try:
+                encoder.close()
+            except Exception as e:
+                self.error = self.error or e
+
+
 class SagemakerStableBaselinesLauncher():
     """
     Sagemaker's Stable Baselines Launcher.
@@ -36,29 +110,101 @@ class SagemakerStableBaselinesLauncher():
         """
         self._model.learn(total_timesteps=self._num_timesteps)
 
-    def _predict(self, model, video_path):
-        """Run predictions on trained RL model.
-        """
+    def _predict(self, model, video_path, frame_skip=1):
+        """Run predictions on trained RL model and record them as a video.
 
-        vr = VideoRecorder(env=self._env, path="{}/rl_out.mp4".format(video_path, str(MPI.COMM_WORLD.Get_rank())),
-                           enabled=True)
+        Frames are encoded on a background thread. Only every ``frame_skip``-th frame is recorded.
+        """
+        if frame_skip < 1:
+            raise ValueError("frame_skip must be at least 1, got %s" % frame_skip)
+        frames_per_sec = self._env.metadata.get('video.frames_per_second', 30)
+        writer = AsyncVideoWriter("{}/rl_out.mp4".format(video_path),
+                                  max(1, int(frames_per_sec // frame_skip)))
         obs = self._env.reset()
-        for i in range(1000):
-            action, _states = model.predict(obs)
-            obs, rewards, dones, info = self._env.step(action)
-            if dones:
-                obs = self._env.reset()
-            self._env.render(mode='rgb_array')
-            vr.capture_frame()
-        vr.close()
-        self._env.close()
-
-    def run(self):
+        try:
+            for i in range(1000):
+                action, _states = model.predict(obs)
+                obs, rewards, dones, info = self._env.step(action)
+                # Vectorized envs reset their finished sub-environments themselves.
+                if not isinstance(self._env, VecEnv) and dones:
+                    obs = self._env.reset()
+                if i % frame_skip == 0:
+                    frame = self._env.render(mode='rgb_array')
+                    if frame is not None:
+                        writer.write(frame)
+        finally:
+            writer.close()
+            self._env.close()
+
+    def evaluate(self, eval_env, num_episodes=10, deterministic=True):
+        """Evaluate the trained RL model on a vectorized environment.
+
+        The observations of all sub-environments are stacked and passed to ``predict`` in one
+        call per step. Each sub-environment contributes an equal share of the episodes, so
+        short episodes are not over-represented.
 
+        Returns:
+            dict: episode reward and length statistics.
+        """
+        num_envs = eval_env.num_envs
+        quotas = np.full(num_envs, num_episodes // num_envs, dtype=np.int64)
+        quotas[:num_episodes % num_envs] += 1
+        completed = np.zeros(num_envs, dtype=np.int64)
+        running_rewards = np.zeros(num_envs)
+        running_lengths = np.zeros(num_envs, dtype=np.int64)
+        episode_rewards = []
+        episode_lengths = []
+
+        obs = eval_env.reset()
+        while (completed < quotas).any():
+            actions, _states = self._model.predict(obs, deterministic=deterministic)
+            obs, rewards, dones, _infos = eval_env.step(actions)
+            running_rewards += rewards
+            running_lengths += 1
+            for i in np.flatnonzero(dones):
+                if completed[i] < quotas[i]:
+                    episode_rewards.append(running_rewards[i])
+                    episode_lengths.append(running_lengths[i])
+                    completed[i] += 1
+                running_rewards[i] = 0
+                running_lengths[i] = 0
+
+        stats = {
+            "episodes": len(episode_rewards),
+            "mean_reward": float(np.mean(episode_rewards)) if episode_rewards else 0.0,
+            "std_reward": float(np.std(episode_rewards)) if episode_rewards else 0.0,
+            "min_reward": float(np.min(episode_rewards)) if episode_rewards else 0.0,
+            "max_reward": float(np.max(episode_rewards)) if episode_rewards else 0.0,
+            "mean_episode_length": float(np.mean(episode_lengths)) if episode_lengths else 0.0,
+        }
+        print("Evaluation over {} episodes on {} envs: {}".format(num_episodes, num_envs, stats))
+        return stats
+
+    def run(self, record_video=True, video_frame_skip=1, eval_env=None, eval_episodes=10):
+        """Train the model, then evaluate it on ``eval_env`` and, if ``record_video``, record a
+        video on rank 0.
+
+        Returns:
+            dict: the evaluation statistics, also saved as eval_stats.json in the output path,
+                or None when no ``eval_env`` is given or on other ranks.
+        """
+        if record_video and video_frame_skip < 1:
+            raise ValueError("video_frame_skip must be at least 1, got %s" % video_frame_skip)
         self._train()
 
+        stats = None
         if MPI.COMM_WORLD.Get_rank() == 0:
-            self._predict(self._model, self._output_path)
+            if eval_env is not None:
+                stats = self.evaluate(eval_env, eval_episodes)
+                eval_env.close()
+                with open(os.path.join(self._output_path, "eval_stats.json"), "w") as f:
+                    json.dump(stats, f)
+        if record_video and MPI.COMM_WORLD.Get_rank() == 0:
+            self._predict(self._model, self._output_path, video_frame_skip)
+        else:
+            # Without a video there is nothing to roll out the trained model for.
+            self._env.close()
+        return stats
 
 
 class SagemakerStableBaselinesPPO1Launcher(SagemakerStableBaselinesLauncher):
@@ -79,6 +225,9 @@ class SagemakerStableBaselinesPPO1Launcher(SagemakerStableBaselinesLauncher):
                                                                    optim_stepsize, optim_batchsize,
                                                                    gamma, lam, schedule,
                                                                    verbose, num_timesteps))
+        if isinstance(env, VecEnv) and env.num_envs > 1:
+            raise ValueError("PPO1 trains on a single environment per MPI rank. "
+                             "Use SagemakerStableBaselinesPPO2Launcher for vectorized environments.")
         super().__init__(env, output_path,
                          PPO1(policy=MlpPolicy,
                               env=env,
@@ -95,10 +244,109 @@ class SagemakerStableBaselinesPPO1Launcher(SagemakerStableBaselinesLauncher):
                          num_timesteps)
 
 
-def create_env(env_id, output_path, seed=0):
+class SagemakerStableBaselinesPPO2Launcher(SagemakerStableBaselinesLauncher):
+    """
+    Sagemaker's Stable Baselines PPO2 Launcher.
+
+    Takes the same hyper parameters as the PPO1 launcher, but trains on a vectorized environment
+    (see ``create_env(num_envs=...)``) so that a single process can keep all cores of a host busy.
+    PPO2 does not average gradients over MPI, so run it with one process per host.
+    """
+
+    def __init__(self, env, output_path, timesteps_per_actorbatch,
+                 clip_param, entcoeff, optim_epochs,
+                 optim_stepsize, optim_batchsize,
+                 gamma, lam, schedule,
+                 verbose, num_timesteps):
+        num_envs = env.num_envs if isinstance(env, VecEnv) else 1
+        # PPO1 batch sizes are per process, PPO2 ones per sub-environment.
+        n_steps, nminibatches = ppo2_batch_layout(max(1, timesteps_per_actorbatch // num_envs),
+                                                  num_envs, optim_batchsize)
+        if schedule == "linear":
+            # PPO1 anneals both the step size and the clip range linearly to 0.
+            learning_rate = lambda progress: optim_stepsize * progress
+            cliprange = lambda progress: clip_param * progress
+        else:
+            learning_rate = optim_stepsize
+            cliprange = clip_param
+        print(
+            "Initializing PPO2 with output_path: {}, num_envs: {} and Hyper Params [n_steps: {}, cliprange: {}, "
+            "ent_coef: {}, noptepochs: {}, learning_rate: {}, nminibatches: {}, gamma: {}, lam: {}, "
+            "schedule: {}, verbose: {}, num_timesteps: {}]".format(output_path, num_envs, n_steps,
+                                                                   clip_param, entcoeff, optim_epochs,
+                                                                   optim_stepsize, nminibatches,
+                                                                   gamma, lam, schedule,
+                                                                   verbose, num_timesteps))
+        super().__init__(env, output_path,
+                         PPO2(policy=MlpPolicy,
+                              env=env,
+                              gamma=gamma,
+                              n_steps=n_steps,
+                              cliprange=cliprange,
+                              ent_coef=entcoeff,
+                              noptepochs=optim_epochs,
+                              learning_rate=learning_rate,
+                              nminibatches=nminibatches,
+                              lam=lam,
+                              verbose=verbose),
+                         num_timesteps)
+
+
+def ppo2_batch_layout(n_steps, num_envs, minibatch_size):
+    """Returns the ``(n_steps, nminibatches)`` to run PPO2 with.
+
+    The number of minibatches is the batch size ``n_steps * num_envs`` divided by
+    ``minibatch_size``, rounded. PPO2 requires it to divide the batch evenly, so ``n_steps`` is
+    rounded up to the next multiple that makes it so, rather than changing the minibatch size.
+    """
+    nminibatches = max(1, int(round(n_steps * num_envs / float(minibatch_size))))
+    step_multiple = nminibatches // math.gcd(nminibatches, num_envs)
+    even_n_steps = -(-n_steps // step_multiple) * step_multiple
+    if even_n_steps != n_steps:
+        logger.warning("Rounded n_steps up from %s to %s so that the batch of %s environments splits "
+                       "evenly into %s minibatches", n_steps, even_n_steps, num_envs, nminibatches)
+    return even_n_steps, nminibatches
+
+
+def create_env(env_id, output_path, seed=0, num_envs=1, vec_env_type="subproc", reward_scale=None):
+    """Creates the environment for this MPI rank.
+
+    Args:
+        env_id (str): gym environment id.
+        output_path (str): directory for the Monitor logs.
+        seed (int): base seed, offset per rank and per sub-environment.
+        num_envs (int): number of environments for this rank. With more than one, they are
+            wrapped in a VecEnv.
+        vec_env_type (str): "subproc" to step the environments in worker processes, or
+            "dummy" to step them sequentially in this process.
+        reward_scale (float): factor to scale the rewards with, applied to the whole VecEnv
+            at once when there is more than one environment.
+    """
     rank = MPI.COMM_WORLD.Get_rank()
     set_global_seeds(seed + 10000 * rank)
-    env = gym.make(env_id)
-    env = Monitor(env, os.path.join(output_path, str(rank)), allow_early_resets=True)
-    env.seed(seed)
+    if num_envs == 1:
+        env = gym.make(env_id)
+        env = Monitor(env, os.path.join(output_path, str(rank)), allow_early_resets=True)
+        env.seed(seed)
+        if reward_scale is not None:
+            env = RewScale(env, reward_scale)
+        return env
+
+    def make_env(index):
+        def _init():
+            env = gym.make(env_id)
+            env = Monitor(env, os.path.join(output_path, "{}_{}".format(rank, index)), allow_early_resets=True)
+            env.seed(seed + 10000 * rank + index)
+            return env
+        return _init
+
+    env_fns = [make_env(i) for i in range(num_envs)]
+    if vec_env_type == "subproc":
+        env = SubprocVecEnv(env_fns)
+    elif vec_env_type == "dummy":
+        env = DummyVecEnv(env_fns)
+    else:
+        raise ValueError("Unknown vec_env_type %s. Expected 'subproc' or 'dummy'." % vec_env_type)
+    if reward_scale is not None:
+        env = VecRewScale(env, reward_scale)
     return env
@@ -1,6 +1,13 @@
 import tensorflow as tf
+import importlib.util
 import os
+import pickle
 import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import ray
 
 
 def atoi(text):
@@ -11,12 +18,43 @@ def natural_keys(text):
     return [atoi(c) for c in re.split('(\d+)', text)]
 
 
-def change_permissions_recursive(path, mode):
-    for root, dirs, files in os.walk(path, topdown=False):
-        for dir in [os.path.join(root, d) for d in dirs]:
-            os.chmod(dir, mode)
-    for file in [os.path.join(root, f) for f in files]:
-        os.chmod(file, mode)
+def _chmod_directory_entries(directory, mode):
+    """Changes the mode of every non-directory entry of ``directory``, relative to a descriptor
+    of the directory, and returns its sub-directories.
+    """
+    subdirectories = []
+    dir_fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                else:
+                    os.chmod(entry.name, mode, dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+    return subdirectories
+
+
+def change_permissions_recursive(path, mode, max_workers=None):
+    """Changes the mode of every file and directory below ``path`` in a single traversal.
+    Directories are listed and their files chmod-ed concurrently on a thread pool. The directories
+    themselves are chmod-ed last, deepest first, so a restrictive ``mode`` cannot block the traversal.
+    """
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    directories = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_chmod_directory_entries, path, mode)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdirectory in future.result():
+                    directories.append(subdirectory)
+                    pending.add(executor.submit(_chmod_directory_entries, subdirectory, mode))
+    directories.sort(key=lambda directory: directory.count(os.sep), reverse=True)
+    for directory in directories:
+        os.chmod(directory, mode)
 
 
 def export_tf_serving(agent, output_dir):
@@ -46,3 +84,52 @@ def export_tf_serving(agent, output_dir):
                 signature_def_map=signature_def_map)
             builder.save()
     print("Saved TensorFlow serving model!")
+
+
+def checkpoint_has_worker_state(checkpoint_path):
+    """Whether an RLlib trainer checkpoint holds the pickled rollout worker state that
+    ``export_policy_from_checkpoint`` restores the policy from. Older releases don't write it.
+    """
+    with open(checkpoint_path, "rb") as f:
+        trainer_state = pickle.load(f)
+    return isinstance(trainer_state, dict) and "worker" in trainer_state
+
+
+def export_policy_from_checkpoint(policy_cls, observation_space, action_space, config, checkpoint_path,
+                                  output_dir, policy_id="default_policy"):
+    """Restores only the policy weights from an RLlib trainer checkpoint and exports them as a
+    TF SavedModel under ``output_dir``/1. No trainer, rollout workers or environments are created.
+    """
+    with open(checkpoint_path, "rb") as f:
+        trainer_state = pickle.load(f)
+    worker_state = pickle.loads(trainer_state["worker"])
+    policy_state = worker_state["state"][policy_id]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0})):
+            policy = policy_cls(observation_space, action_space, config)
+            if hasattr(policy, "set_state"):
+                policy.set_state(policy_state)
+            else:
+                policy.set_weights(policy_state)
+            policy.export_model(os.path.join(output_dir, "1"))
+    print("Saved TensorFlow serving model!")
+
+
+def export_onnx_from_saved_model(saved_model_dir, onnx_path):
+    """Converts a TF SavedModel to ONNX with tf2onnx, if it is installed.
+    The export is optional, so a failed conversion is reported and doesn't fail the job.
+    """
+    if importlib.util.find_spec("tf2onnx") is None:
+        print("tf2onnx is not installed. Skipping ONNX export.")
+        return False
+    try:
+        subprocess.check_call([sys.executable, "-m", "tf2onnx.convert",
+                               "--saved-model", saved_model_dir,
+                               "--output", onnx_path])
+    except subprocess.CalledProcessError as e:
+        print("Failed to export the ONNX model, continuing without it: %s" % e)
+        return False
+    print("Saved ONNX model!")
+    return True